@@ -0,0 +1,175 @@
+import asyncio
+import os
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+
+from . import util
+from .message import Attachment
+from .messenger.messenger import get_logger
+from .store import MessageStore
+
+logger = get_logger(__name__)
+
+# kinds of ids that keep showing up, they are cached even when streaming
+REUSED_KINDS = ("emoji", "sticker")
+
+
+class AttachmentStore:
+    # Downloads go into the hub's cache directory named after the hash of
+    # their content, and are indexed by their id on the platform, e.g.
+    # "Discord:emoji:1234". Emoji, stickers and attachments seen before are
+    # then served from the cache instead of being fetched again.
+    def __init__(
+        self,
+        directory: str,
+        store: MessageStore,
+        max_downloads: int = 8,
+        timeout: float = 60,
+        max_size: Optional[int] = 50 * 1024 * 1024,
+        stream: bool = False,
+        stream_max_size: int = 8 * 1024 * 1024,
+        lazy: bool = False,
+    ) -> None:
+        self.directory = directory
+        self.store = store
+        # shared by every messenger of the hub
+        self.slots = asyncio.Semaphore(max_downloads)
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_size = max_size
+        # Files up to stream_max_size are kept in memory and shared by every
+        # destination instead of being written to the cache, they are gone
+        # after a restart though. Emoji and stickers still go to the cache,
+        # or they would be fetched again every time they are used.
+        self.in_memory = stream_max_size if stream else 0
+        # Only keeps the URL of files anyone can download, and leaves it to
+        # the destinations to fetch them, if at all.
+        self.lazy = lazy
+        self.resolving: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.failed = 0
+
+    def lookup(self, key: str) -> Optional[str]:
+        row = self.store.reader.execute(
+            'SELECT "blob" FROM "blobs" WHERE "key" = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        file_path = os.path.join(self.directory, row[0])
+        try:
+            # keeps files in use from being pruned as old
+            os.utime(file_path)
+        except FileNotFoundError:
+            # removed before its id was forgotten along with it
+            self.forget(key)
+            return None
+        return file_path
+
+    def forget(self, key: str) -> None:
+        def op(con: sqlite3.Connection) -> None:
+            con.execute('DELETE FROM "blobs" WHERE "key" = ?', (key,))
+
+        self.store.submit(op)
+
+    def index(self, key: str, file_path: str) -> None:
+        params = (key, os.path.basename(file_path))
+
+        def op(con: sqlite3.Connection) -> None:
+            con.execute('INSERT OR REPLACE INTO "blobs" VALUES (?, ?)', params)
+
+        self.store.submit(op)
+
+    async def download(
+        self,
+        session: aiohttp.ClientSession,
+        key: str,
+        url: str,
+        headers=None,
+    ) -> Tuple[str, Optional[bytes]]:
+        if (file_path := self.lookup(key)) is not None:
+            self.hits += 1
+            return file_path, None
+        self.misses += 1
+        # keys look like "Discord:emoji:1234"
+        reused = any(f":{kind}:" in key for kind in REUSED_KINDS)
+        async with self.slots:
+            file_path, content = await util.download_to_cache(
+                session,
+                url,
+                self.directory,
+                headers=headers,
+                timeout=self.timeout,
+                max_size=self.max_size,
+                in_memory=0 if reused else self.in_memory,
+            )
+        if content is None:
+            self.index(key, file_path)
+        return file_path, content
+
+    async def download_all(
+        self,
+        session: aiohttp.ClientSession,
+        downloads: List[Tuple[str, str, str, str]],
+        headers=None,
+    ) -> List[Attachment]:
+        # Downloads the (key, url, name, type) of each file concurrently.
+        # Files that failed, or have no URL at all, are left out, so the
+        # message can still be relayed without them. URLs needing headers
+        # can't be lazy.
+        downloads = [d for d in downloads if d[1]]
+        if self.lazy and headers is None:
+            return [
+                Attachment(name, type, "", url=url) for _, url, name, type in downloads
+            ]
+        results = await asyncio.gather(
+            *(
+                self.download(session, key, url, headers)
+                for key, url, _, _ in downloads
+            ),
+            return_exceptions=True,
+        )
+        attachments: List[Attachment] = []
+        for (key, url, name, type), result in zip(downloads, results):
+            if isinstance(result, BaseException):
+                logger.warning("Failed to download %s from %s: %r", key, url, result)
+                self.failed += 1
+            else:
+                attachments.append(Attachment(name, type, *result, url=url))
+        return attachments
+
+    async def resolve(
+        self, session: aiohttp.ClientSession, attachment: Attachment
+    ) -> Optional[Attachment]:
+        # Downloads a lazy attachment, once for all destinations sending it
+        # at the same time. None if the file is too large to be sent, or
+        # has nowhere to be downloaded from.
+        if not attachment.is_lazy:
+            return attachment
+        if not attachment.url:
+            return None
+        url = attachment.url
+        if (task := self.resolving.get(url)) is None:
+            task = self.resolving[url] = asyncio.create_task(
+                self.download(session, f"url:{url}", url)
+            )
+            task.add_done_callback(lambda _: self.resolving.pop(url, None))
+        try:
+            file_path, content = await asyncio.shield(task)
+        except util.FileTooLarge as e:
+            logger.warning("Leaving out %s: %s", attachment.name, e)
+            return None
+        return attachment._replace(file_path=file_path, content=content)
+
+    async def resolve_all(
+        self, session: aiohttp.ClientSession, attachments: List[Attachment]
+    ) -> List[Attachment]:
+        resolved = await asyncio.gather(
+            *(self.resolve(session, a) for a in attachments)
+        )
+        return [a for a in resolved if a is not None]
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "failed": self.failed}
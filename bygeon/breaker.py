@@ -0,0 +1,85 @@
+import asyncio
+import time
+from typing import Dict, Union
+
+from .messenger.messenger import get_logger
+
+logger = get_logger(__name__)
+
+
+class State:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    # Opens after failure_threshold failures in a row. While open, callers
+    # of acquire are parked instead of hitting the destination, until after
+    # reset_timeout a single one of them is let through as a probe. The
+    # timeout doubles with every failed probe, up to max_reset_timeout.
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        reset_timeout: float = 10,
+        max_reset_timeout: float = 300,
+    ) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+
+        self.state = State.CLOSED
+        self.failures = 0
+        self.timeout = reset_timeout
+        self.opened_at = 0.0
+        self.opened = 0
+        self.changed = asyncio.Event()
+
+    def set_state(self, state: str) -> None:
+        if state != self.state:
+            logger.warning("Circuit of %s is %s", self.name, state)
+        self.state = state
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def acquire(self) -> None:
+        while True:
+            if self.state == State.CLOSED:
+                return None
+            if self.state == State.OPEN:
+                delay = self.opened_at + self.timeout - time.monotonic()
+                if delay <= 0:
+                    self.set_state(State.HALF_OPEN)
+                    return None
+                try:
+                    await asyncio.wait_for(self.changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                # a probe is on its way, wait for how it went
+                await self.changed.wait()
+
+    def success(self) -> None:
+        self.failures = 0
+        self.timeout = self.reset_timeout
+        if self.state != State.CLOSED:
+            self.set_state(State.CLOSED)
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.state == State.HALF_OPEN:
+            self.timeout = min(self.timeout * 2, self.max_reset_timeout)
+            self.open()
+        elif self.state == State.CLOSED and self.failures >= self.failure_threshold:
+            self.open()
+
+    def open(self) -> None:
+        self.opened += 1
+        self.opened_at = time.monotonic()
+        self.set_state(State.OPEN)
+
+    @property
+    def stats(self) -> Dict[str, Union[str, int]]:
+        return {"state": self.state, "failures": self.failures, "opened": self.opened}
@@ -1,102 +1,238 @@
-from typing import List
-from pypika import Query, Column, Table
-import sqlite3
+import asyncio
+import os
+from typing import Dict, List, Optional
 
-from .messenger.messenger import Messenger
-from .message import Message
+import orjson
 
-import bygeon.util as util
+from .attachments import AttachmentStore
+from .breaker import CircuitBreaker
+from .messenger.messenger import Messenger, get_logger
+from .message import Message
+from .outbox import Outbox, Operation, OperationKind
+from .store import MessageStore, NativeId
+from .retention import Retention
+from .scheduler import Scheduler
 
 
 class Hub:
-    def __init__(self, name: str) -> None:
+    def __init__(
+        self, name: str, config: Optional[dict] = None, cache_path: str = "cache"
+    ) -> None:
+        config = config or {}
+        database = config.get("Database", {})
+
         self.clients: List[Messenger] = []
-        self.con = sqlite3.connect(f"{name}.db", check_same_thread=False)
-        self.cur = self.con.cursor()
+        self.store = MessageStore(
+            f"{name}.db",
+            synchronous=database.get("synchronous", "NORMAL"),
+            batch_size=database.get("batch_size", 256),
+            batch_interval=database.get("batch_interval", 0.02),
+            cache_size=database.get("cache_size", 4096),
+            cache_ttl=database.get("cache_ttl", 6 * 60 * 60),
+        )
         self.name = name
+        self.logger = get_logger(name)
+        # seconds between stats logged, 0 for none
+        self.stats_interval = config.get("Stats", {}).get("interval", 300)
+        self.cache_path = os.path.join(os.path.abspath(cache_path), name)
+        attachments = config.get("Attachments", {})
+        self.attachments = AttachmentStore(
+            self.cache_path,
+            self.store,
+            max_downloads=attachments.get("max_downloads", 8),
+            timeout=attachments.get("timeout", 60),
+            max_size=attachments.get("max_size", 50 * 1024 * 1024),
+            stream=attachments.get("stream", False),
+            stream_max_size=attachments.get("stream_max_size", 8 * 1024 * 1024),
+            lazy=attachments.get("lazy", False),
+        )
+
+        outbox = config.get("Outbox", {})
+        self.outbox = Outbox(
+            self.store,
+            max_attempts=outbox.get("max_attempts", 8),
+            base_delay=outbox.get("base_delay", 1),
+            max_delay=outbox.get("max_delay", 300),
+        )
+
+        retention = config.get("Retention", {})
+        self.retention = Retention(
+            self.store,
+            self.cache_path,
+            max_age=retention.get("max_age"),
+            max_rows=retention.get("max_rows"),
+            max_cache_size=retention.get("max_cache_size"),
+            batch_size=retention.get("batch_size", 500),
+            interval=retention.get("interval", 300),
+            outbox=self.outbox,
+        )
+
+        delivery = config.get("Delivery", {})
+        self.scheduler = Scheduler(
+            name,
+            workers=delivery.get("workers", 4),
+            queue_size=delivery.get("queue_size", 256),
+            ordered=delivery.get("ordered", True),
+        )
+
+        self.breaker_config = config.get("Breaker", {})
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        # Outbox ids, per destination, that didn't fit into its full queue
+        # and are moved there as it frees up. Operations are parked rather
+        # than waited for, so a stalled destination doesn't hold up the
+        # others.
+        self.parked: Dict[str, List[int]] = {}
+        # Parked operations whose attachments are only held in memory, by
+        # outbox id. The outbox can't rebuild those, only after a restart
+        # are they sent without them.
+        self.streamed: Dict[int, Operation] = {}
 
     @property
     def client_names(self) -> List[str]:
         return [client.name for client in self.clients]
 
-    def start(self):
+    def stats(self) -> dict:
+        return {
+            "cache": self.store.cache.stats,
+            "attachments": {**self.attachments.stats, **self.retention.stats},
+            "queued": self.scheduler.stats,
+            "outbox": self.outbox.stats,
+            "circuits": {name: b.stats for name, b in self.breakers.items()},
+            "messengers": {client.name: client.stats for client in self.clients},
+        }
+
+    async def run(self) -> None:
+        self.retention.start()
+        self.scheduler.start()
+        # the outbox is replayed right away, so sessions have to be open
         for client in self.clients:
-            client.start()
-
-    def join(self):
+            client.open()
+        self.replay()
+        if self.stats_interval > 0:
+            asyncio.create_task(self.log_stats())
+        await asyncio.gather(*(client.start() for client in self.clients))
+
+    async def log_stats(self) -> None:
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            try:
+                options = orjson.OPT_NON_STR_KEYS
+                stats = orjson.dumps(self.stats(), default=str, option=options)
+            except Exception:
+                self.logger.exception("Failed to collect stats")
+            else:
+                self.logger.info(f"Stats: {stats.decode()}")
+
+    def replay(self) -> None:
+        # what is left in the outbox is parked and picked up like the rest
+        ranges = self.outbox.pending_ranges()
         for client in self.clients:
-            client.join()
+            if (entries := ranges.get(client.name)) is not None:
+                self.parked[client.name] = list(entries)
+                self.unpark(client)
 
-    def new_message(self, message: Message):
+    async def new_message(self, message: Message) -> None:
         self.new_entry(message)
-        for client in self.clients:
-            if client.name != message.origin:
-                util.run_in_thread(client.send_message, (message,))
+        operation = Operation(
+            OperationKind.SEND, message.origin, message.origin_id, message
+        )
+        await self.dispatch(operation)
 
     def new_entry(self, message: Message) -> None:
-        origin_id = message.origin_id
-        origin = message.origin
-        entry = (origin_id if origin == s else None for s in self.client_names)
-        q = Query.into(self.table).insert(*tuple(entry))
-        self.execute_sql(str(q))
-
-    # FIXME
-    def update_entry(
-        self, m: Message, sent_messenger: str, sent_id: str
-    ) -> None:  # noqa
-        sql = f'UPDATE "messages" SET "{sent_messenger}" = \'{sent_id}\' WHERE "{m.origin}" = \'{m.origin_id}\''  # noqa
-        # q = Query.update(self.table).set(sent_messenger, sent_id).where(m.origin == m.origin_id) # noqa
-        self.execute_sql(sql)
+        self.store.add(message.origin, message.origin_id)
+
+    def update_entry(self, m: Message, sent_messenger: str, sent_id: str) -> None:
+        if sent_id is None:
+            return None
+        self.store.link(m.origin, m.origin_id, sent_messenger, sent_id)
 
     def add_client(self, client):
         self.clients.append(client)
+        self.scheduler.add_destination(client.name)
+        self.breakers[client.name] = CircuitBreaker(
+            client.name,
+            failure_threshold=self.breaker_config.get("failure_threshold", 5),
+            reset_timeout=self.breaker_config.get("reset_timeout", 10),
+            max_reset_timeout=self.breaker_config.get("max_reset_timeout", 300),
+        )
 
-    def reply_message(self, m: Message, reply_to: str) -> None:
+    async def reply_message(self, m: Message, reply_to: str) -> None:
         self.new_entry(m)
-        orig = m.origin
-        sql = f'SELECT * FROM "messages" WHERE "{orig}" = \'{reply_to}\''
-        cur = self.cur.execute(sql)
+        operation = Operation(OperationKind.SEND, m.origin, m.origin_id, m, reply_to)
+        await self.dispatch(operation)
 
-        if cur.rowcount == 0:
-            self.new_message(m)
-            return None
+    async def modify_message(self, m: Message) -> None:
+        await self.dispatch(Operation(OperationKind.MODIFY, m.origin, m.origin_id, m))
 
-        for row in cur:
-            for i, client in enumerate(self.clients):
-                if client.name != orig:
-                    util.run_in_thread(client.send_message, (m, row[i]))
-        print(self.cur.execute(sql))
-
-    def modify_message(self, m: Message) -> None:
-        orig = m.origin
-        sent_id = m.origin_id
-        sql = f'SELECT * FROM "messages" WHERE "{orig}" = \'{sent_id}\''
-        cur = self.cur.execute(sql)
-        for row in cur:
-            for i, client in enumerate(self.clients):
-                if client.name != orig:
-                    util.run_in_thread(client.modify_message, (m, row[i]))
-        ...
-
-    def recall_message(self, orig: str, recalled_id: str) -> None:
-        sql = f'SELECT * FROM "messages" WHERE "{orig}" = \'{recalled_id}\''
-        cur = self.cur.execute(sql)
-        for row in cur:
-            for i, client in enumerate(self.clients):
-                if client.name != orig:
-                    util.run_in_thread(client.recall_message, (row[i],))
+    async def recall_message(self, orig: str, recalled_id: NativeId) -> None:
+        await self.dispatch(Operation(OperationKind.RECALL, orig, recalled_id))
 
-    def init_database(self, keep_data=True):
-        columns = tuple(
-            Column(s, "VARCHAR(255)", nullable=True) for s in self.client_names
+    async def dispatch(self, operation: Operation) -> None:
+        clients = [c for c in self.clients if c.name != operation.origin]
+        entry_ids = await self.outbox.record([(c.name, operation) for c in clients])
+        streamed = operation.message is not None and any(
+            a.content is not None for a in operation.message.attachments
         )
+        for client, entry_id in zip(clients, entry_ids):
+            if (parked := self.parked.get(client.name)) is not None:
+                parked[1] = entry_id
+            elif self.scheduler.free(client.name) <= 0:
+                self.parked[client.name] = [entry_id, entry_id]
+            else:
+                self.scheduler.submit_nowait(
+                    client.name, self.deliver, (client, entry_id, operation)
+                )
+                continue
+            if streamed:
+                self.streamed[entry_id] = operation
+
+    def unpark(self, client: Messenger) -> None:
+        if (parked := self.parked.get(client.name)) is None:
+            return None
+        free = self.scheduler.free(client.name)
+        if free <= 0:
+            return None
+        first, last = parked
+        entries = self.outbox.pending(client.name, first, last, free)
+        for entry_id, operation in entries:
+            operation = self.streamed.pop(entry_id, operation)
+            self.scheduler.submit_nowait(
+                client.name, self.deliver, (client, entry_id, operation)
+            )
+        if len(entries) < free:
+            del self.parked[client.name]
+        else:
+            parked[0] = entries[-1][0] + 1
+
+    async def deliver(
+        self, client: Messenger, entry_id: int, operation: Operation
+    ) -> None:
+        try:
+            await self.outbox.deliver(
+                entry_id,
+                lambda: self.perform(client, operation),
+                self.breakers[client.name],
+            )
+        finally:
+            self.unpark(client)
+
+    # The ids are looked up by the delivering worker rather than upfront,
+    # so everything queued before for this client has been sent by then.
+    async def perform(self, client: Messenger, operation: Operation) -> None:
+        kind, origin, origin_id, m, reply_to = operation
+        match kind:
+            case OperationKind.SEND:
+                ref_id = None
+                if reply_to is not None:
+                    ref_id = self.store.lookup(origin, reply_to).get(client.name)
+                await client.send_message(m, ref_id)
+            case OperationKind.MODIFY:
+                if m_id := self.store.lookup(origin, origin_id).get(client.name):
+                    await client.modify_message(m, m_id)
+            case OperationKind.RECALL:
+                if m_id := self.store.lookup(origin, origin_id).get(client.name):
+                    await client.recall_message(m_id)
+
+    def init_database(self, keep_data=True):
         if not keep_data:
-            self.execute_sql('DROP TABLE IF EXISTS "messages"')
-            create_table = Query.create_table("messages").columns(*columns)
-            self.execute_sql(str(create_table))
-        self.table = Table("messages")
-
-    def execute_sql(self, query: str) -> None:
-        print(query)
-        self.cur.execute(query)
-        self.con.commit()
+            self.store.clear()
@@ -1,7 +1,10 @@
+import asyncio
+import signal
 import tomli
 from .messenger.slack import Slack
 from .messenger.discord import Discord
 from .messenger.cqhttp import CQHttp
+from .messenger.gateway import PoolOptions
 from .hub import Hub
 from typing import List
 
@@ -11,13 +14,14 @@ def main():
         config = tomli.load(f)
 
     hub_configs = config["Hubs"]
+    cache_path = config.get("Bygeon", {}).get("cache_path", "cache")
     hubs: List[Hub] = []
 
     for (i, hub_config) in enumerate(hub_configs):
         hub_name = hub_config.get("name", f"HUB-{i}")
         keep_data = hub_config["keep_data"]
 
-        hub = Hub(hub_name)
+        hub = Hub(hub_name, hub_config, cache_path=cache_path)
         hubs.append(hub)
 
         if hub_config.get("Discord") != None:
@@ -25,6 +29,10 @@ def main():
                 bot_token=hub_config["Discord"]["bot_token"],
                 channel_id=hub_config["Discord"]["channel_id"],
                 hub=hub,
+                pool=pool_options(hub_config["Discord"]),
+                compress=hub_config["Discord"].get("compress", True),
+                shards=hub_config["Discord"].get("shards"),
+                shard_processes=hub_config["Discord"].get("shard_processes", False),
             )
             hub.add_client(discord)
         if hub_config.get("Slack") != None:
@@ -33,24 +41,53 @@ def main():
                 bot_token=hub_config["Slack"]["bot_token"],
                 channel_id=hub_config["Slack"]["channel_id"],
                 hub=hub,
+                pool=pool_options(hub_config["Slack"]),
+                warm_user_cache=hub_config["Slack"].get("warm_user_cache", False),
+                connections=hub_config["Slack"].get("connections", 1),
             )
             hub.add_client(slack)
         if hub_config.get("CQHttp") != None:
 
             ws_url = hub_config["CQHttp"].get("ws_url", "ws://localhost:8080/")
-            http_url = hub_config["CQHttp"].get("ws_url", "http://localhost:5700/")
+            http_url = hub_config["CQHttp"].get("http_url", "http://localhost:5700/")
 
             cqhttp = CQHttp(
                 group_id=hub_config["CQHttp"]["group_id"],
                 hub=hub,
                 ws_url=ws_url,
                 http_url=http_url,
+                pool=pool_options(hub_config["CQHttp"]),
             )
 
             hub.add_client(cqhttp)
 
         hub.init_database(keep_data=keep_data)
-        hub.start()
 
-    for hub in hubs:
-        hub.join()
+    try:
+        asyncio.run(run(hubs))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    finally:
+        # writes still queued, e.g. mappings and delivered outbox entries
+        for hub in hubs:
+            hub.store.close()
+
+
+def pool_options(messenger_config: dict) -> PoolOptions:
+    # left out options are None, and don't override other messengers'
+    return PoolOptions(
+        size=messenger_config.get("pool_size"),
+        keepalive_timeout=messenger_config.get("keepalive_timeout"),
+        warm_connections=messenger_config.get("warm_connections"),
+        connect_timeout=messenger_config.get("connect_timeout"),
+        read_timeout=messenger_config.get("read_timeout"),
+    )
+
+
+async def run(hubs: List[Hub]) -> None:
+    # every hub and messenger shares this one event loop
+    task = asyncio.current_task()
+    if task is not None:
+        # stopped like with Ctrl+C, so the stores are closed
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+    await asyncio.gather(*(hub.run() for hub in hubs))
@@ -1,4 +1,5 @@
-from typing import NamedTuple, List
+from os.path import basename
+from typing import NamedTuple, List, Optional
 from enum import Enum
 
 class AttachmentType(Enum):
@@ -10,6 +11,28 @@ class Attachment(NamedTuple):
     name: str
     type: str
     file_path: str
+    # set in streaming mode, file_path is only a file name then
+    content: Optional[bytes] = None
+    # where the file came from, lazy attachments have nothing else
+    url: Optional[str] = None
+
+    @property
+    def filename(self) -> str:
+        return basename(self.file_path)
+
+    @property
+    def is_lazy(self) -> bool:
+        return not self.file_path and self.content is None
+
+    @property
+    def is_image(self) -> bool:
+        return self.type.startswith("image")
+
+    def read(self) -> bytes:
+        if self.content is not None:
+            return self.content
+        with open(self.file_path, "rb") as f:
+            return f.read()
 
 class Message(NamedTuple):
     origin: str
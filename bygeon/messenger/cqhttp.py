@@ -1,17 +1,72 @@
-import threading
-from typing import Union, cast
+import base64
+import re
+import time
+from typing import Any, Tuple, Union, cast
 from urllib.parse import urljoin
 
-from websocket import WebSocketApp as WSApp
-
+import aiohttp
 import orjson
-import requests
 
-import bygeon.util as util
 from bygeon.hub import Hub
-from bygeon.message import Message, Attachment
-from .definition.cqhttp import WSMessage, PostType, Endpoints
-from .messenger import Messenger
+from bygeon.message import Message
+from .definition.cqhttp import WSMessage, PostType, MetaEventType, Endpoints
+from .messenger import Messenger, DeliveryError
+from .gateway import Gateway, PoolOptions, WS
+
+HEARTBEAT = b'"meta_event_type":"%s"' % MetaEventType.HEARTBEAT.encode()
+
+
+class CQHttpGateway(Gateway["CQHttp"]):
+    def __init__(self, ws_url: str) -> None:
+        super().__init__(ws_url)
+        self.ws_url = ws_url
+        # matches the events of any bridged group
+        self.groups = re.compile(b"(?!)")
+        self.skipped = 0
+
+    def subscribe(
+        self,
+        target_id: Any,
+        messenger: "CQHttp",
+        pool: PoolOptions = PoolOptions(),
+        warm_urls: Tuple[str, ...] = (),
+    ) -> None:
+        super().subscribe(target_id, messenger, pool, warm_urls)
+        ids = b"|".join(b"%d" % group_id for group_id in self.subscribers)
+        self.groups = re.compile(rb'"group_id":\s*(?:%s)\b' % ids)
+
+    def is_ignored(self, message: bytes) -> bool:
+        # Events of other groups, private messages and meta events are
+        # dropped before decoding them, apart from heartbeats.
+        if HEARTBEAT in message:
+            return False
+        if self.groups.search(message) is None:
+            self.skipped += 1
+            return True
+        return False
+
+    async def on_message(self, ws: WS, message: Union[str, bytes]) -> None:
+        if isinstance(message, str):
+            message = message.encode()
+        if self.is_ignored(message):
+            return None
+        ws_message: WSMessage = orjson.loads(message)
+        if ws_message.get("meta_event_type") == MetaEventType.HEARTBEAT:
+            self.handle_heartbeat(ws, ws_message)
+            return None
+        group_id = ws_message.get("group_id")
+        if (cqhttp := self.subscribers.get(group_id)) is not None:
+            self.dispatch(group_id, lambda: cqhttp.handle_event(ws_message))
+
+    def handle_heartbeat(self, ws: WS, ws_message: WSMessage) -> None:
+        # go-cqhttp sends one every interval milliseconds, stamped in
+        # seconds, so the latency is only as precise as that
+        self.latency = max(0, time.time() - ws_message["time"])
+        if self.liveness is None:
+            self.set_liveness(self.watch(ws, ws_message["interval"] / 1000))
+
+    async def get_websocket_url(self) -> str:
+        return self.ws_url
 
 
 class CQHttp(Messenger):
@@ -23,25 +78,37 @@ class CQHttp(Messenger):
     def recall_url(self) -> str:
         return urljoin(self.http_url, Endpoints.DELETE_MESSAGE)
 
-    def __init__(self, group_id: str, hub: Hub, ws_url: str, http_url: str) -> None:
+    def __init__(
+        self,
+        group_id: str,
+        hub: Hub,
+        ws_url: str,
+        http_url: str,
+        pool: PoolOptions = PoolOptions(),
+    ) -> None:
         self.group_id = int(group_id)
         self.hub = hub
         self.logger = self.get_logger()
         self.ws_url = ws_url
         self.http_url = http_url
 
-    def on_open(self, ws) -> None:
-        self._on_open(ws)
+        self.gateway: CQHttpGateway = CQHttpGateway.get(ws_url)
+        self.gateway.subscribe(
+            self.group_id,
+            self,
+            pool,
+            warm_urls=(urljoin(http_url, Endpoints.GET_STATUS),),
+        )
 
-    def on_error(self, ws, e) -> None:
-        self._on_error(ws, e)
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        return self.gateway.session
 
-    def on_close(self, ws, close_status_code, close_msg) -> None:
-        self._on_close(ws, close_status_code, close_msg)
-        self.reconnect()
+    @property
+    def stats(self) -> dict:
+        return {**self.gateway.stats, "skipped": self.gateway.skipped}
 
-    def on_message(self, ws: WSApp, message: str) -> None:
-        ws_message: WSMessage = orjson.loads(message)
+    async def handle_event(self, ws_message: WSMessage) -> None:
         post_type = ws_message["post_type"]
         is_reply = False
         message_group_id = ws_message.get("group_id")
@@ -59,7 +126,7 @@ class CQHttp(Messenger):
 
                 data = ws_message["message"]
                 text = ""
-                attachments = []
+                images = []
                 for d in data:
                     if d["type"] == "reply":
                         is_reply = True
@@ -71,43 +138,43 @@ class CQHttp(Messenger):
                     elif d["type"] == "image":
                         url = d["data"].get("url", "")
                         url = cast(str, url)
+                        # the file name is already a hash of the image
                         fn = d["data"]["file"]
-                        filename = f"{self.name}_{fn}"
-                        path = self.generate_cache_path(self.hub.name)
-                        file_path = util.download_to_cache(url, path, filename)
-                        attachments.append(Attachment(fn, "image", file_path))
+                        images.append((fn, url))
+                attachments = await self.hub.attachments.download_all(
+                    self.session,
+                    [
+                        (f"{self.name}:image:{fn}", url, fn, "image")
+                        for fn, url in images
+                    ],
+                )
                 m = Message(self.name, message_id, author, text, attachments)
                 if is_reply:
-                    self.hub.reply_message(m, ref_id)
+                    await self.hub.reply_message(m, ref_id)
                 else:
-                    self.hub.new_message(m)
+                    await self.hub.new_message(m)
             case PostType.NOTICE:
                 if ws_message["self_id"] == ws_message["user_id"]:
                     return None
                 recalled_id = ws_message["message_id"]
-                self.hub.recall_message(self.name, recalled_id)
+                await self.hub.recall_message(self.name, recalled_id)
 
-    def recall_message(self, message_id: str) -> None:
+    async def recall_message(self, message_id: str) -> None:
         payload = {
             "message_id": message_id,
         }
-        r = requests.post(self.recall_url, json=payload)
-        self.logger.info("Trying to recall: " + message_id)
-        self.logger.info(r.json())
-
-    def modify_message(self, m: Message, m_id: str) -> None:
-        self.recall_message(m_id)
+        self.logger.info("Trying to recall: " + str(message_id))
+        async with self.session.post(self.recall_url, json=payload) as r:
+            response = await self.check_response(r)
+        self.logger.info(response)
 
-        self.send_message(m)
-        ...
+    async def modify_message(self, m: Message, m_id: str) -> None:
+        await self.recall_message(m_id)
 
-    def reconnect(self) -> None:
-        self.ws.close()
-        self.start()
-        self.join()
+        await self.send_message(m)
         ...
 
-    def send_message(self, m: Message, ref_id=None) -> None:
+    async def send_message(self, m: Message, ref_id=None) -> None:
         payload: dict[str, Union[str, int]] = {
             "group_id": self.group_id,
             "message": "",
@@ -115,34 +182,45 @@ class CQHttp(Messenger):
         message_string = ""
         for attachment in m.attachments:
             main_type = attachment.type.split("/")[0]
-            message_string += f"[CQ:{main_type},file=file:{attachment.file_path}]"
-
-        self.logger.info(ref_id)
+            if attachment.content is not None:
+                content = base64.b64encode(attachment.content).decode()
+                file = f"base64://{content}"
+            elif attachment.is_lazy and attachment.url:
+                # go-cqhttp downloads it by itself
+                file = attachment.url
+            else:
+                file = f"file:{attachment.file_path}"
+            message_string += f"[CQ:{main_type},file={file}]"
+
+        text = f"[{m.author_username}]: {m.text}"
         if ref_id is not None:
-            message_string += f"[CQ:reply,id={ref_id}]"
-        message_string += f"[{m.author_username}]: {m.text}"
-        self.logger.info(f"Sending message with CQCode: {message_string}")
+            text = f"[CQ:reply,id={ref_id}]" + text
+        message_string += text
+        # only the names, files sent inline would flood the log
+        names = [attachment.name for attachment in m.attachments]
+        self.logger.info(f"Sending message with CQCode: {text}, files: {names}")
         payload["message"] = message_string
-        self.logger.info(payload)
 
-        r = requests.post(self.send_url, json=payload)
-        self.logger.info(r.text)
+        async with self.session.post(self.send_url, json=payload) as r:
+            response = await self.check_response(r)
+        self.logger.info(response)
 
-        response = r.json()
         message_id = response.get("data").get("message_id")
         self.hub.update_entry(m, self.name, message_id)
 
-    def start(self) -> None:
-        self.ws = WSApp(
-            self.ws_url,
-            on_open=self.on_open,
-            on_message=self.on_message,
-            on_error=self.on_error,
-            on_close=self.on_close,
-        )
-        self.thread = threading.Thread(target=self.ws.run_forever)
-        self.thread.daemon = True
-        self.thread.start()
-
-    def join(self) -> None:
-        self.thread.join()
+    async def check_response(self, r: aiohttp.ClientResponse) -> dict:
+        if r.status >= 400:
+            raise DeliveryError(
+                f"{r.status}: {await r.text()}",
+                retryable=r.status == 429 or r.status >= 500,
+            )
+        response = orjson.loads(await r.read())
+        if response.get("status") == "failed":
+            raise DeliveryError(str(response), retryable=False)
+        return response
+
+    def open(self) -> None:
+        self.gateway.open()
+
+    async def start(self) -> None:
+        await self.gateway.run()
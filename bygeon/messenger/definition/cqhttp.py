@@ -5,6 +5,7 @@ from typing_extensions import NotRequired
 class Endpoints:
     SEND_GROUP_MESSAGE = "send_group_msg"
     DELETE_MESSAGE = "delete_msg"
+    GET_STATUS = "get_status"
 
 
 class PostType:
@@ -49,6 +50,7 @@ class CQMessage(TypedDict):
 
 class WSMessage(TypedDict):
     post_type: str
+    group_id: NotRequired[int]
     meta_event_type: str
     message_type: str
     sender: Sender
@@ -56,3 +58,6 @@ class WSMessage(TypedDict):
     message: List[CQMessage]
     self_id: NotRequired[int]
     user_id: NotRequired[int]
+    # heartbeat meta events
+    time: NotRequired[int]
+    interval: NotRequired[int]
@@ -3,11 +3,15 @@ from typing_extensions import NotRequired
 
 
 class Endpoints:
-    GATEWAY = "wss://gateway.discord.gg/?v=10&encoding=json"
+    GATEWAY_QUERY = "?v=10&encoding=json"
+    GATEWAY = "wss://gateway.discord.gg/" + GATEWAY_QUERY
+    GET_GATEWAY = "https://discordapp.com/api/gateway"
+    GET_GATEWAY_BOT = "https://discordapp.com/api/gateway/bot"
     SEND_MESSAGE = "https://discordapp.com/api/channels/{}/messages"
     DELETE_MESSAGE = "https://discordapp.com/api/channels/{}/messages/{}"
     EDIT_MESSAGE = "https://discordapp.com/api/channels/{}/messages/{}"
     GET_EMOJI = "https://cdn.discordapp.com/emojis/{}"
+    GET_STICKER = "https://media.discordapp.net/stickers/{}"
 
 
 class ReferencedMessage(TypedDict):
@@ -159,11 +163,25 @@ class Application(TypedDict):
     flags: NotRequired[int]
 
 
+class SessionStartLimit(TypedDict):
+    total: int
+    remaining: int
+    reset_after: int
+    max_concurrency: int
+
+
+class GatewayBot(TypedDict):
+    url: str
+    shards: int
+    session_start_limit: SessionStartLimit
+
+
 class ReadyEvent(TypedDict):
     v: int
     user: User
     guilds: List[UnavailableGuild]
     session_id: str
+    resume_gateway_url: str
     shard: Optional[List[int]]
     application: Application
 
@@ -172,7 +190,24 @@ class WebsocketMessage(TypedDict):
     op: int
     t: str
     s: int
-    d: Union[MessageCreateEvent, ReadyEvent, Hello, MessageDeleteEvent]
+    d: Union[MessageCreateEvent, ReadyEvent, Hello, MessageDeleteEvent, bool]
+
+
+class CloseCode:
+    UNKNOWN_ERROR = 4000
+    AUTHENTICATION_FAILED = 4004
+    INVALID_SEQUENCE = 4007
+    SESSION_TIMED_OUT = 4009
+    INVALID_SHARD = 4010
+    SHARDING_REQUIRED = 4011
+    INVALID_API_VERSION = 4012
+    INVALID_INTENTS = 4013
+    DISALLOWED_INTENTS = 4014
+
+
+class Intents:
+    GUILD_MESSAGES = 1 << 9
+    MESSAGE_CONTENT = 1 << 15
 
 
 class Opcode:
@@ -182,6 +217,7 @@ class Opcode:
     PRESENCE_UPDATE = 3
     RESUME = 6
     RECONNECT = 7
+    INVALID_SESSION = 9
     HELLO = 10
     HEARTBEAT_ACK = 11
 
@@ -191,3 +227,4 @@ class EventName:
     MESSAGE_UPDATE = "MESSAGE_UPDATE"
     MESSAGE_DELETE = "MESSAGE_DELETE"
     READY = "READY"
+    RESUMED = "RESUMED"
@@ -11,6 +11,11 @@ class Endpoints:
     AUTH_TEST = "https://slack.com/api/auth.test"
     FILE_UPLOAD = "https://slack.com/api/files.upload"
     CHAT_UPDATE = "https://slack.com/api/chat.update"
+    API_TEST = "https://slack.com/api/api.test"
+    USERS_LIST = "https://slack.com/api/users.list"
+    GET_UPLOAD_URL = "https://slack.com/api/files.getUploadURLExternal"
+    COMPLETE_UPLOAD = "https://slack.com/api/files.completeUploadExternal"
+    FILES_INFO = "https://slack.com/api/files.info"
 
 
 class WSMessageType:
@@ -19,8 +24,16 @@ class WSMessageType:
     EVENTS_API = "events_api"
 
 
+class DisconnectReason:
+    # sent a few seconds before refresh_requested
+    WARNING = "warning"
+    REFRESH_REQUESTED = "refresh_requested"
+    LINK_DISABLED = "link_disabled"
+
+
 class EventType:
     MESSAGE = "message"
+    USER_CHANGE = "user_change"
 
 
 class MessageEventSubtype:
@@ -50,6 +63,8 @@ class Event(TypedDict):
 class MessageEvent(Event):
     channel: str
     user: str
+    bot_id: NotRequired[str]
+    username: NotRequired[str]
     text: NotRequired[str]
     deleted_ts: NotRequired[str]
     thread_ts: NotRequired[str]
@@ -82,6 +97,15 @@ class UserProfileChangedEvent(TypedDict):
     pass
 
 
+class User(TypedDict):
+    id: str
+    name: str
+
+
+class UserChangeEvent(Event):
+    user: User
+
+
 class Payload(TypedDict):
     token: str
     team_id: str
@@ -100,3 +124,5 @@ class WSMessage(TypedDict):
     envelope_id: str
     payload: Payload
     type: str
+    # disconnect messages
+    reason: NotRequired[str]
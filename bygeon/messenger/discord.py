@@ -1,74 +1,172 @@
-import threading
-import time
+import asyncio
+import multiprocessing
+import random
 import re
-from io import BytesIO
-from os.path import basename
-from typing import cast, List, Dict, Any, Union, Optional
+import zlib
+from multiprocessing.connection import Connection
+from multiprocessing.process import BaseProcess
+from typing import cast, List, Dict, Any, Tuple, Union, Optional
 
-from websocket import WebSocketApp as WSApp
-
-import requests
+import aiohttp
 import orjson
 
-import bygeon.util as util
 from bygeon.hub import Hub
 from bygeon.message import Message, Attachment
-from .messenger import Messenger
+from .messenger import Messenger, DeliveryError
+from .gateway import Gateway, PoolOptions, WS, RECONNECT_DELAY
+from .ratelimit import RateLimiter
 from .definition.discord import (
     MessageUpdateEvent,
     Opcode,
     EventName,
     WebsocketMessage,
     Endpoints,
+    Intents,
 )
 from .definition.discord import (
     MessageCreateEvent,
     ReadyEvent,
     Hello,
     MessageDeleteEvent,
+    CloseCode,
+    GatewayBot,
 )
 
 
-class Discord(Messenger):
+# ends every complete message of the zlib-stream transport
+ZLIB_SUFFIX = b"\x00\x00\xff\xff"
+
+# closing with any other code than 1000 or 1001 keeps the session resumable
+RESUMABLE_CLOSE_CODE = CloseCode.UNKNOWN_ERROR
+
+# reconnecting won't help with these
+FATAL_CLOSE_CODES = (
+    CloseCode.AUTHENTICATION_FAILED,
+    CloseCode.INVALID_SHARD,
+    CloseCode.SHARDING_REQUIRED,
+    CloseCode.INVALID_API_VERSION,
+    CloseCode.INVALID_INTENTS,
+    CloseCode.DISALLOWED_INTENTS,
+)
+# the session is gone, but a new one can be identified
+SESSION_CLOSE_CODES = (CloseCode.INVALID_SEQUENCE, CloseCode.SESSION_TIMED_OUT)
+
+# seconds between identifies of shards in the same bucket
+IDENTIFY_INTERVAL = 5
+
+# messages are all a bridge needs, including their content
+INTENTS = Intents.GUILD_MESSAGES | Intents.MESSAGE_CONTENT
+
+# Discord starts every dispatch like this, so events nobody wants can be
+# told apart without decoding them.
+DISPATCH_HEAD = re.compile(rb'\{"t":"(\w+)","s":(\d+),"op":0,')
+SESSION_EVENTS = (EventName.READY.encode(), EventName.RESUMED.encode())
+ROUTED_EVENTS = tuple(
+    e.encode()
+    for e in (
+        EventName.MESSAGE_CREATE,
+        EventName.MESSAGE_UPDATE,
+        EventName.MESSAGE_DELETE,
+    )
+)
+
+
+class ConnectionState:
+    DISCONNECTED = "disconnected"
+    IDENTIFYING = "identifying"
+    RESUMING = "resuming"
+    CONNECTED = "connected"
+
+
+class DiscordGateway(Gateway["Discord"]):
     session_id: Optional[str]
     sequence: Optional[int]
 
-    def __init__(self, bot_token: str, channel_id: str, hub: Hub) -> None:
-        self.token = bot_token
-        self.channel_id = channel_id
-        self.hub = hub
+    def __init__(self, token: str) -> None:
+        super().__init__(token)
+        self.token = token
         self.sequence = None
         self.session_id = None
-
-        self.logger = self.get_logger()
+        self.resume_gateway_url: Optional[str] = None
+        self.state = ConnectionState.DISCONNECTED
+        self.identifies = 0
+        self.resumes = 0
+        self.bot_id: Optional[str] = None
+        self.ratelimiter = RateLimiter()
+        # One zlib context spans the whole connection, frames are
+        # compressed against everything sent before them.
+        self.compress = True
+        self.inflator = zlib.decompressobj()
+        self.buffer = bytearray()
+        self.received_bytes = 0
+        self.inflated_bytes = 0
+        self.skipped = 0
+        # (id, count) of the shard this connection is
+        self.shard: Optional[Tuple[int, int]] = None
+        # None for the count Discord recommends
+        self.shard_count: Optional[int] = None
+        # parses the dispatches of each shard in a process of its own
+        self.shard_processes = False
+        self.shards: List[DiscordGateway] = []
+        self.processes: Dict[int, BaseProcess] = {}
+
+    def _on_open(self, ws) -> None:
+        super()._on_open(ws)
+        self.inflator = zlib.decompressobj()
+        self.buffer.clear()
+
+    def _on_close(self, ws, close_status_code, close_msg) -> None:
+        super()._on_close(ws, close_status_code, close_msg)
+        self.state = ConnectionState.DISCONNECTED
+        if close_status_code in FATAL_CLOSE_CODES:
+            self.logger.error("Not reconnecting after close code %s", close_status_code)
+            self.running = False
+        elif close_status_code in SESSION_CLOSE_CODES:
+            self.reset_session()
+
+    def _on_error(self, ws, e) -> None:
+        super()._on_error(ws, e)
+        self.state = ConnectionState.DISCONNECTED
 
     @property
-    def headers(self):
-        return {"Authorization": f"Bot {self.token}"}
-
-    def on_open(self, ws) -> None:
-        self._on_open(ws)
+    def resumable(self) -> bool:
+        return self.session_id is not None and self.sequence is not None
 
-    def on_error(self, ws, e) -> None:
-        self._on_error(ws, e)
+    def reset_session(self) -> None:
+        self.session_id = None
+        self.sequence = None
+        self.resume_gateway_url = None
 
-    def on_close(self, ws, close_status_code, close_msg) -> None:
-        self._on_close(ws, close_status_code, close_msg)
-        self.reconnect()
+    async def reconnect(self, ws: WS, code: int = RESUMABLE_CLOSE_CODE) -> None:
+        await super().reconnect(ws, code)
 
-    def heartbeat(self, ws: WSApp, interval: int) -> None:
+    async def heartbeat(self, ws: WS) -> None:
         payload = {
-            "op": 1,
-            "d": None,
+            "op": Opcode.HEARTBEAT,
+            "d": self.sequence,
         }
-        while True:
-            time.sleep(interval / 1000)
-            if ws.sock is not None:
-                ws.send(orjson.dumps(payload))
-            else:
-                break
+        await ws.send_str(orjson.dumps(payload).decode())
 
-    def on_message(self, ws: WSApp, message: str) -> None:
+    def inflate(self, message: bytes) -> Optional[bytes]:
+        # a message may be split over several frames
+        self.received_bytes += len(message)
+        self.buffer += message
+        if not self.buffer.endswith(ZLIB_SUFFIX):
+            return None
+        data = self.inflator.decompress(self.buffer)
+        self.buffer.clear()
+        self.inflated_bytes += len(data)
+        return data
+
+    async def on_message(self, ws: WS, message: Union[str, bytes]) -> None:
+        if isinstance(message, bytes):
+            if (data := self.inflate(message)) is None:
+                return None
+            message = data
+        elif isinstance(message, str):
+            message = message.encode()
+        if self.is_ignored(message):
+            return None
 
         ws_message: WebsocketMessage = orjson.loads(message)
         opcode = ws_message["op"]
@@ -77,72 +175,396 @@ class Discord(Messenger):
             case Opcode.HELLO:
                 hello = cast(Hello, ws_message["d"])
                 heartbeat_interval = hello["heartbeat_interval"]
-                self.send_identity(ws)
-                threading.Thread(
-                    target=self.heartbeat, args=(ws, heartbeat_interval), daemon=True
-                ).start()
+                if self.resumable:
+                    await self.send_resume(ws)
+                else:
+                    await self.send_identity(ws)
+                self.set_liveness(
+                    self.keep_alive(ws, heartbeat_interval / 1000, self.heartbeat)
+                )
+            case Opcode.RECONNECT:
+                self.logger.info("Reconnect requested")
+                await self.reconnect(ws)
+            case Opcode.INVALID_SESSION:
+                if ws_message["d"]:
+                    await self.reconnect(ws)
+                else:
+                    self.logger.warning("Session invalidated, identifying again")
+                    self.reset_session()
+                    await asyncio.sleep(random.uniform(1, 5))
+                    await self.send_identity(ws)
             case Opcode.HEARTBEAT:
-                # TODO
-                pass
+                # asked for by the server, on top of the regular ones
+                await self.heartbeat(ws)
+            case Opcode.HEARTBEAT_ACK:
+                self.acknowledge()
             case Opcode.DISPATCH:
-                self.logger.debug(ws_message)
-                self.handle_dispatch(ws_message)
+                await self.handle_dispatch(ws_message)
             case _:
                 return None
 
-    def handle_dispatch(self, ws_message: WebsocketMessage) -> None:
-        t = ws_message["t"]
+    def is_ignored(self, message: bytes) -> bool:
+        # True for dispatches of other events or channels than the bridged
+        if (head := DISPATCH_HEAD.match(message)) is None:
+            return False
+        event, sequence = head.groups()
+        if event in SESSION_EVENTS:
+            return False
+        if event in ROUTED_EVENTS and self.is_bridged(message):
+            return False
+        # still needed to resume
+        self.sequence = int(sequence)
+        self.skipped += 1
+        return True
+
+    def is_bridged(self, message: bytes) -> bool:
+        # may also match a channel only referenced, which is decoded to
+        # find out
+        return any(
+            b'"channel_id":"%s"' % channel_id.encode() in message
+            for channel_id in self.subscribers
+        )
+
+    async def handle_dispatch(self, ws_message: WebsocketMessage) -> None:
+        # When resuming, the events missed in between are dispatched before
+        # RESUMED, and handled like any other.
         self.sequence = ws_message["s"]
 
+        if ws_message["t"] == EventName.READY:
+            ready_event = cast(ReadyEvent, ws_message["d"])
+            self.handle_ready(ready_event)
+            return None
+        if ws_message["t"] == EventName.RESUMED:
+            self.logger.info("Resumed session")
+            self.state = ConnectionState.CONNECTED
+            return None
+
+        await self.route(ws_message)
+
+    async def route(self, ws_message: WebsocketMessage) -> None:
+        # the messenger of the channel is on the hub it belongs to
+        channel_id = cast(dict, ws_message["d"]).get("channel_id")
+        if (discord := self.subscribers.get(channel_id)) is not None:
+            self.dispatch(channel_id, lambda: discord.handle_dispatch(ws_message))
+
+    def handle_ready(self, data: ReadyEvent) -> None:
+        self.bot_id = data["user"]["id"]
+        self.session_id = data["session_id"]
+        self.resume_gateway_url = data["resume_gateway_url"]
+        self.state = ConnectionState.CONNECTED
+
+    async def send_identity(self, ws: WS) -> None:
+        self.state = ConnectionState.IDENTIFYING
+        self.identifies += 1
+        payload = self.identity_payload
+        await ws.send_str(payload.decode())
+
+    async def send_resume(self, ws: WS) -> None:
+        self.state = ConnectionState.RESUMING
+        self.resumes += 1
+        payload = {
+            "op": Opcode.RESUME,
+            "d": {
+                "token": self.token,
+                "session_id": self.session_id,
+                "seq": self.sequence,
+            },
+        }
+        await ws.send_str(orjson.dumps(payload).decode())
+
+    @property
+    def identity_payload(self) -> bytes:
+        # XXX
+        payload: Dict[str, Union[dict, Any]] = {
+            "op": Opcode.IDENTIFY,
+            "d": {
+                "token": self.token,
+                "properties": {
+                    "os": "linux",
+                    "browser": "bygeon",
+                    "device": "bygeon",
+                },
+                "large_threshold": 250,
+                "compress": False,
+                "intents": INTENTS,
+            },
+        }
+        if self.shard is not None:
+            payload["d"]["shard"] = list(self.shard)
+
+        return orjson.dumps(payload)
+
+    async def connect(self) -> None:
+        async with self.session:
+            count, concurrency = await self.get_shard_count()
+            self.logger.info("Connecting %d shard(s)", count)
+            if not self.shard_processes:
+                self.shards = [self] + [self.sibling() for _ in range(1, count)]
+            # only max_concurrency shards may identify at the same time
+            await asyncio.gather(
+                *(
+                    self.run_shard((i, count), i // concurrency * IDENTIFY_INTERVAL)
+                    for i in range(count)
+                )
+            )
+
+    async def get_shard_count(self) -> Tuple[int, int]:
+        # (shards, how many of them may identify at once)
+        headers = {"Authorization": f"Bot {self.token}"}
+        try:
+            async with self.session.get(
+                Endpoints.GET_GATEWAY_BOT, headers=headers
+            ) as r:
+                r.raise_for_status()
+                gateway_bot = cast(GatewayBot, orjson.loads(await r.read()))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.logger.warning(f"Failed to get the recommended shard count: {e}")
+            return self.shard_count or 1, 1
+        count = self.shard_count or gateway_bot["shards"]
+        return count, gateway_bot["session_start_limit"]["max_concurrency"]
+
+    def sibling(self) -> "DiscordGateway":
+        # another shard, sharing everything but the connection
+        gateway = DiscordGateway(self.token)
+        gateway.subscribers = self.subscribers
+        gateway.session = self.session
+        gateway.ratelimiter = self.ratelimiter
+        gateway.compress = self.compress
+        gateway.queues = self.queues
+        return gateway
+
+    async def run_shard(self, shard: Tuple[int, int], delay: float) -> None:
+        await asyncio.sleep(delay)
+        if self.shard_processes:
+            await self.run_process(shard)
+            return None
+        gateway = self.shards[shard[0]]
+        gateway.shard = shard
+        await gateway.run_websocket()
+
+    async def run_process(self, shard: Tuple[int, int]) -> None:
+        # Restarts the process if it crashed, it only exits by itself when
+        # reconnecting wouldn't help.
+        context = multiprocessing.get_context("spawn")
+        loop = asyncio.get_running_loop()
+        while True:
+            reader, writer = context.Pipe(duplex=False)
+            args = (self.token, shard, list(self.subscribers), self.compress, writer)
+            process = context.Process(
+                target=run_shard_process,
+                args=args,
+                name=f"{self.name}-{shard[0]}",
+                daemon=True,
+            )
+            process.start()
+            writer.close()
+            self.processes[shard[0]] = process
+            await self.forward(reader)
+            await loop.run_in_executor(None, process.join)
+            if process.exitcode == 0:
+                return None
+            self.logger.error(f"Shard {shard[0]} exited with {process.exitcode}")
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def forward(self, reader: Connection) -> None:
+        # handles what a shard process passes on, in order, until it exits
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue[Optional[bytes]] = asyncio.Queue()
+        fd = reader.fileno()
+
+        def receive() -> None:
+            try:
+                while reader.poll():
+                    queue.put_nowait(reader.recv_bytes())
+            except EOFError:
+                loop.remove_reader(fd)
+                queue.put_nowait(None)
+
+        loop.add_reader(fd, receive)
+        try:
+            while (data := await queue.get()) is not None:
+                ws_message: WebsocketMessage = orjson.loads(data)
+                try:
+                    if ws_message["t"] == EventName.READY:
+                        self.bot_id = cast(ReadyEvent, ws_message["d"])["user"]["id"]
+                    else:
+                        await self.route(ws_message)
+                except Exception:
+                    self.logger.exception("Failed to handle message")
+        finally:
+            loop.remove_reader(fd)
+            reader.close()
+
+    async def get_websocket_url(self) -> str:
+        url = Endpoints.GATEWAY
+        if self.resumable and self.resume_gateway_url is not None:
+            url = self.resume_gateway_url.rstrip("/") + "/" + Endpoints.GATEWAY_QUERY
+        if self.compress:
+            url += "&compress=zlib-stream"
+        return url
+
+    @property
+    def stats(self) -> dict:
+        return {
+            **super().stats,
+            "state": self.state,
+            "identifies": self.identifies,
+            "resumes": self.resumes,
+            "received_bytes": self.received_bytes,
+            "inflated_bytes": self.inflated_bytes,
+            "skipped": self.skipped,
+        }
+
+
+class ForwardingShard(DiscordGateway):
+    # A shard in a process of its own, passing the dispatches for the
+    # subscribed channels on to the main process.
+    def __init__(self, token: str, pipe: Connection) -> None:
+        super().__init__(token)
+        self.pipe = pipe
+
+    async def connect(self) -> None:
+        self.open()
+        async with self.session:
+            await self.run_websocket()
+
+    def handle_ready(self, data: ReadyEvent) -> None:
+        super().handle_ready(data)
+        ready = {"t": EventName.READY, "d": {"user": data["user"]}}
+        self.pipe.send_bytes(orjson.dumps(ready))
+
+    async def route(self, ws_message: WebsocketMessage) -> None:
+        channel_id = cast(dict, ws_message["d"]).get("channel_id")
+        if channel_id in self.subscribers:
+            self.pipe.send_bytes(orjson.dumps(ws_message))
+
+
+def run_shard_process(
+    token: str,
+    shard: Tuple[int, int],
+    channel_ids: List[str],
+    compress: bool,
+    pipe: Connection,
+) -> None:
+    gateway = ForwardingShard(token, pipe)
+    gateway.shard = shard
+    gateway.compress = compress
+    gateway.subscribers = dict.fromkeys(channel_ids)
+    asyncio.run(gateway.connect())
+
+
+class Discord(Messenger):
+    def __init__(
+        self,
+        bot_token: str,
+        channel_id: str,
+        hub: Hub,
+        pool: PoolOptions = PoolOptions(),
+        compress: bool = True,
+        shards: Optional[int] = None,
+        shard_processes: bool = False,
+    ) -> None:
+        self.token = bot_token
+        self.channel_id = channel_id
+        self.hub = hub
+
+        self.logger = self.get_logger()
+
+        self.gateway: DiscordGateway = DiscordGateway.get(bot_token)
+        self.gateway.compress = self.gateway.compress and compress
+        if shards is not None:
+            self.gateway.shard_count = shards
+        self.gateway.shard_processes = self.gateway.shard_processes or shard_processes
+        self.gateway.subscribe(
+            channel_id, self, pool, warm_urls=(Endpoints.GET_GATEWAY,)
+        )
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        return self.gateway.session
+
+    @property
+    def headers(self):
+        return {"Authorization": f"Bot {self.token}"}
+
+    @property
+    def stats(self) -> dict:
+        stats = {**self.gateway.ratelimiter.stats, **self.gateway.stats}
+        if len(self.gateway.shards) > 1:
+            stats["shards"] = [shard.stats for shard in self.gateway.shards]
+        if self.gateway.processes:
+            processes = self.gateway.processes.values()
+            stats["shard_processes"] = sum(p.is_alive() for p in processes)
+        return stats
+
+    async def request(
+        self, method: str, route: str, url: str, **kwargs
+    ) -> aiohttp.ClientResponse:
+        return await self.gateway.ratelimiter.request(
+            self.session,
+            method,
+            route,
+            self.channel_id,
+            url,
+            headers=self.headers,
+            **kwargs,
+        )
+
+    async def handle_dispatch(self, ws_message: WebsocketMessage) -> None:
+        t = ws_message["t"]
+
         match t:
             case EventName.MESSAGE_CREATE:
                 create_event = cast(MessageCreateEvent, ws_message["d"])
-                self.handle_message_create(create_event)
+                await self.handle_message_create(create_event)
             case EventName.MESSAGE_DELETE:
                 delete_event = cast(MessageDeleteEvent, ws_message["d"])
                 message_id = delete_event["id"]
-                self.hub.recall_message(self.name, message_id)
-            case EventName.READY:
-                ready_event = cast(ReadyEvent, ws_message["d"])
-                self.handle_ready(ready_event)
+                await self.hub.recall_message(self.name, message_id)
             case EventName.MESSAGE_UPDATE:
                 update_event = cast(MessageUpdateEvent, ws_message["d"])
                 text = update_event["content"]
                 username = update_event["author"]["username"]
                 message_id = update_event["id"]
                 m = Message(self.name, message_id, username, text, [])
-                self.hub.modify_message(m)
+                await self.hub.modify_message(m)
             case _:
                 return None
 
-    def handle_ready(self, data: ReadyEvent) -> None:
-        self.bot_id = data["user"]["id"]
-        self.session_id = data["session_id"]
-
-    def handle_reply(self, m: Message, ref_id: str) -> None:
-        self.hub.reply_message(m, ref_id)
+    async def handle_reply(self, m: Message, ref_id: str) -> None:
+        await self.hub.reply_message(m, ref_id)
 
-    def handle_modify(self, data: MessageUpdateEvent) -> None:
+    async def handle_modify(self, data: MessageUpdateEvent) -> None:
         message_id = data["id"]
         author = data["author"]
         username = author["username"]
         text = data["content"]
         m = Message(self.name, message_id, username, text, [])
-        self.hub.modify_message(m)
+        await self.hub.modify_message(m)
 
-    def modify_message(self, m: Message, m_id: str) -> None:
+    async def modify_message(self, m: Message, m_id: str) -> None:
         url = Endpoints.EDIT_MESSAGE.format(self.channel_id, m_id)
 
         payload = {
             "content": f"[{m.author_username}]: {m.text}",
         }
 
-        requests.patch(url, headers=self.headers, json=payload)
+        r = await self.request("PATCH", Endpoints.EDIT_MESSAGE, url, json=payload)
+        await self.check_response(r)
 
-    def handle_message_create(self, data: MessageCreateEvent) -> None:
+    async def download_all(
+        self, downloads: List[Tuple[str, str, str, str]]
+    ) -> List[Attachment]:
+        # (url, key, name, type) of each file, all fetched at once
+        return await self.hub.attachments.download_all(
+            self.session,
+            [(f"{self.name}:{key}", url, name, t) for url, key, name, t in downloads],
+        )
+
+    async def handle_message_create(self, data: MessageCreateEvent) -> None:
         if data.get("channel_id") != self.channel_id:
             return None
-        elif data["author"].get("id") == self.bot_id:
+        elif data["author"].get("id") == self.gateway.bot_id:
             return None
 
         origin_id = data["id"]
@@ -152,18 +574,15 @@ class Discord(Messenger):
 
         author = data["author"]
         username = author["username"]
-        attachments: List[Attachment] = []
+        downloads: List[Tuple[str, str, str, str]] = []
         for attachment in data["attachments"]:
             url = attachment["url"]
 
             fn = attachment["id"]
-            filename = f"{self.name}_{fn}"
 
             full_type = attachment["content_type"]
 
-            path = self.generate_cache_path(self.hub.name)
-            file_path = util.download_to_cache(url, path, filename)
-            attachments.append(Attachment(fn, full_type, file_path))
+            downloads.append((url, f"attachment:{fn}", fn, full_type))
 
         emoji_regex = r"<:(.+):(\d+)>"
         emoji_re = re.compile(emoji_regex)
@@ -175,24 +594,22 @@ class Discord(Messenger):
         for a_emoji_name, a_emoji_id in a_emoji_list:
             fn = f"{a_emoji_name}_{a_emoji_id}.gif"
             url = Endpoints.GET_EMOJI.format(a_emoji_id) + ".gif"
-            path = self.generate_cache_path(self.hub.name)
-            file_path = util.download_to_cache(url, path, fn)
             full_type = "image/gif"
-            attachments.append(Attachment(fn, full_type, file_path))
+            downloads.append((url, f"emoji:{fn}", fn, full_type))
             text = text.replace(f"<a:{a_emoji_name}:{a_emoji_id}>", "")
 
         for emoji_name, emoji_id in emoji_list:
             fn = f"{emoji_name}_{emoji_id}.png"
             url = Endpoints.GET_EMOJI.format(emoji_id) + ".png"
-            path = self.generate_cache_path(self.hub.name)
-            file_path = util.download_to_cache(url, path, fn)
             full_type = "image/png"
-            attachments.append(Attachment(fn, full_type, file_path))
+            downloads.append((url, f"emoji:{fn}", fn, full_type))
             text = text.replace(f"<:{emoji_name}:{emoji_id}>", "")
 
         if (sticker_items := data.get("sticker_items")) is not None:
             for sticker in sticker_items:
                 fn = sticker["id"]
+                # APNG stickers are served as .png as well
+                url = Endpoints.GET_STICKER.format(fn) + ".png"
                 match sticker["format_type"]:
                     case 1:
                         fn += ".png"
@@ -200,31 +617,37 @@ class Discord(Messenger):
                     case 2:
                         fn += ".apng"
                         full_type = "image/apng"
-                    case 3:
+                    case 4:
+                        fn += ".gif"
+                        full_type = "image/gif"
+                        url = Endpoints.GET_STICKER.format(sticker["id"]) + ".gif"
+                    case _:
                         continue
                         # fn += ".lottie"
                         # full_type = "application/json"
-                path = self.generate_cache_path(self.hub.name)
-                file_path = util.download_to_cache(url, path, filename)
-                attachments.append(Attachment(fn, full_type, file_path))
+                downloads.append((url, f"sticker:{fn}", fn, full_type))
 
+        attachments = await self.download_all(downloads)
         m = Message(self.name, origin_id, username, text, attachments)
         if (ref_message := data["referenced_message"]) is not None:
             ref_id = ref_message["id"]
-            self.hub.reply_message(m, ref_id)
+            await self.hub.reply_message(m, ref_id)
         else:
-            self.hub.new_message(m)
+            await self.hub.new_message(m)
 
-    def recall_message(self, message_id: str) -> None:
-        r = requests.delete(
+    async def recall_message(self, message_id: str) -> None:
+        r = await self.request(
+            "DELETE",
+            Endpoints.DELETE_MESSAGE,
             Endpoints.DELETE_MESSAGE.format(self.channel_id, message_id),
-            headers=self.headers,
         )
-        self.log_response(r)
+        await self.check_response(r)
 
-    def send_message(self, m: Message, ref_id=None) -> None:
+    async def send_message(self, m: Message, ref_id=None) -> None:
+        links, attachments = self.split_links(m.attachments)
+        text = "\n".join([m.text, *links])
         payload: dict[str, Union[str, dict]] = {
-            "content": f"[{m.author_username}]: {m.text}"
+            "content": f"[{m.author_username}]: {text}"
         }
         if ref_id is not None:
             payload["message_reference"] = {
@@ -232,93 +655,49 @@ class Discord(Messenger):
                 "message_id": ref_id,
             }
 
-        files = []
-        for (i, attachment) in enumerate(m.attachments):
-            fn = basename(attachment.file_path)
-            a_type = attachment.type
-            files.append(
-                (f"files[{i}]", (fn, open(attachment.file_path, "rb"), a_type))
-            )
-
-        if len(files) > 0:
-            # XXX
-            payload_io = BytesIO(orjson.dumps(payload))
-            files.append(
-                (
+        url = Endpoints.SEND_MESSAGE.format(self.channel_id)
+        attachments = await self.hub.attachments.resolve_all(self.session, attachments)
+        if len(attachments) > 0:
+            # in streaming mode every destination shares the same bytes
+            files = [(attachment, attachment.read()) for attachment in attachments]
+
+            def form() -> aiohttp.FormData:
+                form = aiohttp.FormData()
+                for (i, (attachment, content)) in enumerate(files):
+                    form.add_field(
+                        f"files[{i}]",
+                        content,
+                        filename=attachment.filename,
+                        content_type=attachment.type,
+                    )
+                form.add_field(
                     "payload_json",
-                    (None, payload_io, "application/json"),
-                )  # type: ignore[arg-type]
-            )
-            r = requests.post(
-                Endpoints.SEND_MESSAGE.format(self.channel_id),
-                headers=self.headers,
-                files=files,
-            )
+                    orjson.dumps(payload).decode(),
+                    content_type="application/json",
+                )
+                return form
+
+            r = await self.request("POST", Endpoints.SEND_MESSAGE, url, data=form)
         else:
-            r = requests.post(
-                Endpoints.SEND_MESSAGE.format(self.channel_id),
-                json=payload,
-                headers=self.headers,
-            )
+            r = await self.request("POST", Endpoints.SEND_MESSAGE, url, json=payload)
 
-        self.log_response(r)
+        await self.check_response(r)
+        response = await r.json()
 
-        message_id: str = r.json().get("id")
+        message_id: str = response.get("id")
         self.hub.update_entry(m, self.name, message_id)
 
-    def send_identity(self, ws: WSApp) -> None:
-        payload = self.identity_payload
-        print(payload)
-        ws.send(payload)
-
-    @property
-    def identity_payload(self) -> bytes:
-        # XXX
-        payload: Dict[str, Union[dict, Any]] = {
-            "op": Opcode.IDENTIFY,
-            "d": {
-                "token": self.token,
-                "properties": {
-                    "os": "linux",
-                    "browser": "bygeon",
-                    "device": "bygeon",
-                },
-                "large_threshold": 250,
-                "compress": False,
-                "intents": (1 << 15) + (1 << 9),
-            },
-        }
-
-        if self.sequence is not None:
-            payload["sequence"] = self.sequence
-        if self.session_id is not None:
-            payload["d"]["session_id"] = self.session_id
-
-        return orjson.dumps(payload)
-
-    def log_response(self, r: requests.Response) -> None:
-        if r.status_code != 200:
-            self.logger.error(r.text)
-        else:
-            self.logger.debug(r.text)
+    async def check_response(self, r: aiohttp.ClientResponse) -> None:
+        text = await r.text()
+        if r.status >= 400:
+            self.logger.error(text)
+            raise DeliveryError(
+                f"{r.status}: {text}", retryable=r.status == 429 or r.status >= 500
+            )
+        self.logger.debug(text)
 
-    def reconnect(self) -> None:
-        # XXX
-        self.ws.close()
-        self.start()
-        self.join()
-
-    def start(self) -> None:
-        self.ws = WSApp(
-            Endpoints.GATEWAY,
-            on_open=self.on_open,
-            on_message=self.on_message,
-            on_error=self.on_error,
-            on_close=self.on_close,
-        )
-        self.thread = threading.Thread(target=self.ws.run_forever)
-        self.thread.daemon = True
-        self.thread.start()
+    def open(self) -> None:
+        self.gateway.open()
 
-    def join(self) -> None:
-        self.thread.join()
+    async def start(self) -> None:
+        await self.gateway.run()
@@ -0,0 +1,313 @@
+import asyncio
+import logging
+import random
+import time
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    ClassVar,
+    Coroutine,
+    Dict,
+    Generic,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
+
+import aiohttp
+from aiohttp import ClientWebSocketResponse as WS, WSMsgType
+
+from .messenger import get_logger
+
+# seconds, doubled for every failed attempt in a row
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 60
+# a connection that lasted this long is reconnected right away when it drops
+HEALTHY_AFTER = 10
+# seconds to wait for a dead connection to close
+CLOSE_TIMEOUT = 2
+
+M = TypeVar("M")
+
+
+class PoolOptions(NamedTuple):
+    # None for options that weren't configured, see DEFAULT_POOL
+    # connections kept per host
+    size: Optional[int] = None
+    # seconds an idle connection is kept open
+    keepalive_timeout: Optional[float] = None
+    # connections opened per host before the first message
+    warm_connections: Optional[int] = None
+    # seconds to wait for a connection, and for data once connected, so
+    # requests to an unreachable platform fail instead of hanging
+    connect_timeout: Optional[float] = None
+    read_timeout: Optional[float] = None
+
+
+DEFAULT_POOL = PoolOptions(
+    size=10,
+    keepalive_timeout=60,
+    warm_connections=2,
+    connect_timeout=10,
+    read_timeout=30,
+)
+
+
+def merge_pools(a: PoolOptions, b: PoolOptions) -> PoolOptions:
+    # the larger of the options both configured, else the one that is
+    return PoolOptions(
+        *(y if x is None else x if y is None else max(x, y) for x, y in zip(a, b))
+    )
+
+
+class Gateway(Generic[M]):
+    # One websocket connection per credential, shared by the messengers of
+    # every hub using it and dispatching to them by channel or group id.
+    instances: ClassVar[Dict[Tuple[str, str], "Gateway"]] = {}
+
+    logger: logging.Logger
+    session: aiohttp.ClientSession
+
+    def __init__(self, key: str) -> None:
+        self.key = key
+        self.subscribers: Dict[Any, M] = {}
+        self.task: Optional[asyncio.Task] = None
+        self.pool = PoolOptions()
+        self.warm_urls: List[str] = []
+        self.logger = get_logger(self.name)
+        # cleared when reconnecting would not help, e.g. for a bad token
+        self.running = True
+        self.failures = 0
+        # set when the server asked for the reconnect
+        self.reconnecting = False
+        # seconds between websocket pings, for platforms without heartbeats
+        # of their own
+        self.ping_interval: Optional[float] = None
+        # when the heartbeat still waiting for its acknowledgement was sent
+        self.heartbeat_sent: Optional[float] = None
+        self.last_received = 0.0
+        self.latency: Optional[float] = None
+        # connections given up on as dead while still open
+        self.zombies = 0
+        self.liveness: Optional[asyncio.Task] = None
+        # set while the liveness check closes a dead connection
+        self.dropping = False
+        # target id -> events waiting to be handled, in order
+        self.queues: Dict[Any, asyncio.Queue] = {}
+
+    @classmethod
+    def get(cls, key: str):
+        instance = Gateway.instances.get((cls.__name__, key))
+        if instance is None:
+            instance = Gateway.instances[(cls.__name__, key)] = cls(key)
+        return instance
+
+    @property
+    def name(self) -> str:
+        return self.__class__.__name__
+
+    def subscribe(
+        self,
+        target_id: Any,
+        messenger: M,
+        pool: PoolOptions = PoolOptions(),
+        warm_urls: Tuple[str, ...] = (),
+    ) -> None:
+        self.subscribers[target_id] = messenger
+        # the session is shared, so it gets the largest pool asked for
+        self.pool = merge_pools(self.pool, pool)
+        self.warm_urls.extend(url for url in warm_urls if url not in self.warm_urls)
+
+    @property
+    def pool_options(self) -> PoolOptions:
+        # the defaults for whatever no messenger configured
+        return PoolOptions(
+            *(d if v is None else v for v, d in zip(self.pool, DEFAULT_POOL))
+        )
+
+    def open(self) -> None:
+        if not hasattr(self, "session"):
+            pool = self.pool_options
+            connector = aiohttp.TCPConnector(
+                limit=0,
+                limit_per_host=pool.size,
+                keepalive_timeout=pool.keepalive_timeout,
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=None,
+                connect=pool.connect_timeout,
+                sock_read=pool.read_timeout,
+            )
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    async def run(self) -> None:
+        # the first messenger to start connects, the others wait along
+        if self.task is None:
+            self.open()
+            self.task = asyncio.create_task(self.connect(), name=self.name)
+            asyncio.create_task(self.warm_up())
+        await asyncio.shield(self.task)
+
+    async def warm_up(self) -> None:
+        # Opens connections ahead of time, so the first relayed messages
+        # don't pay for the TCP and TLS handshakes.
+        async def request(url: str) -> None:
+            async with self.session.head(url) as r:
+                await r.read()
+
+        pool = self.pool_options
+        count = min(pool.warm_connections, pool.size)
+        requests = [request(url) for url in self.warm_urls for _ in range(count)]
+        for result in await asyncio.gather(*requests, return_exceptions=True):
+            if isinstance(result, Exception):
+                self.logger.warning(f"Failed to warm up connection: {result}")
+
+    async def connect(self) -> None:
+        async with self.session:
+            await self.run_websocket()
+
+    def _on_open(self, ws) -> None:
+        self.logger.info("Opened WebSocket connection")
+
+    def _on_error(self, ws, e) -> None:
+        self.logger.error(f"WebSocket encountered error: {e}")
+
+    def _on_close(self, ws, close_status_code, close_msg) -> None:
+        self.logger.error(f"WebSocket closed: {close_msg}")
+
+    async def get_websocket_url(self) -> str: ...
+
+    def reconnect_delay(self) -> float:
+        if self.failures == 0:
+            return 0
+        delay = min(MAX_RECONNECT_DELAY, RECONNECT_DELAY * 2 ** (self.failures - 1))
+        # jittered, so gateways dropped together don't reconnect together
+        return random.uniform(delay / 2, delay)
+
+    async def reconnect(self, ws: WS, code: int = 1000) -> None:
+        self.reconnecting = True
+        await ws.close(code=code)
+
+    def set_liveness(self, check: Optional[Coroutine]) -> None:
+        # one liveness check runs at a time, for the current connection
+        if self.liveness is not None:
+            self.liveness.cancel()
+        self.liveness = None if check is None else asyncio.create_task(check)
+
+    async def keep_alive(
+        self, ws: WS, interval: float, send: Callable[[WS], Awaitable[None]]
+    ) -> None:
+        # Sends a heartbeat every interval seconds. If the previous one is
+        # still not acknowledged by then, the connection is dead even though
+        # the socket is open, and is dropped for a new one.
+        self.heartbeat_sent = None
+        while not ws.closed:
+            await asyncio.sleep(interval)
+            if self.heartbeat_sent is not None:
+                self.logger.warning("Heartbeat not acknowledged, reconnecting")
+                await self.drop(ws)
+                return None
+            self.heartbeat_sent = time.monotonic()
+            await send(ws)
+
+    def acknowledge(self) -> None:
+        if self.heartbeat_sent is not None:
+            self.latency = time.monotonic() - self.heartbeat_sent
+            self.heartbeat_sent = None
+
+    async def watch(self, ws: WS, interval: float) -> None:
+        # For platforms sending heartbeats themselves: nothing received for
+        # two of their intervals means the connection is dead.
+        while not ws.closed:
+            await asyncio.sleep(interval)
+            if time.monotonic() - self.last_received > 2 * interval:
+                self.logger.warning("No heartbeat received, reconnecting")
+                await self.drop(ws)
+                return None
+
+    async def drop(self, ws: WS) -> None:
+        # the other end won't answer the closing handshake either
+        self.zombies += 1
+        self.dropping = True
+        try:
+            await asyncio.wait_for(self.reconnect(ws), CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+
+    async def ping(self, ws: WS) -> None:
+        await ws.ping()
+
+    async def run_websocket(self) -> None:
+        # Reconnects for as long as the gateway runs.
+        while self.running:
+            opened_at = None
+            try:
+                url = await self.get_websocket_url()
+                # pongs are only seen with autoping off
+                async with self.session.ws_connect(url, autoping=False) as ws:
+                    opened_at = self.last_received = time.monotonic()
+                    self.dropping = False
+                    self._on_open(ws)
+                    if self.ping_interval is not None:
+                        self.set_liveness(
+                            self.keep_alive(ws, self.ping_interval, self.ping)
+                        )
+                    try:
+                        async for msg in ws:
+                            self.last_received = time.monotonic()
+                            if msg.type == WSMsgType.PING:
+                                await ws.pong(msg.data)
+                            elif msg.type == WSMsgType.PONG:
+                                self.acknowledge()
+                            elif msg.type in (WSMsgType.TEXT, WSMsgType.BINARY):
+                                try:
+                                    await self.on_message(ws, msg.data)
+                                except Exception:
+                                    self.logger.exception("Failed to handle message")
+                            elif msg.type == WSMsgType.ERROR:
+                                self._on_error(ws, ws.exception())
+                    finally:
+                        if self.dropping and self.liveness is not None:
+                            # lets it close with its code and time limit
+                            await self.liveness
+                            self.liveness = None
+                        self.set_liveness(None)
+                    self._on_close(ws, ws.close_code, f"code {ws.close_code}")
+            except Exception as e:
+                self._on_error(None, e)
+
+            if self.reconnecting or (
+                opened_at is not None and time.monotonic() - opened_at > HEALTHY_AFTER
+            ):
+                self.reconnecting = False
+                self.failures = 0
+            else:
+                self.failures += 1
+            if self.running:
+                await asyncio.sleep(self.reconnect_delay())
+
+    async def on_message(self, ws: WS, message: Union[str, bytes]) -> None: ...
+
+    def dispatch(self, target_id: Any, handle: Callable[[], Awaitable[None]]) -> None:
+        # Handled by a worker per target rather than while reading, so slow
+        # downloads neither stall the heartbeats nor the other targets.
+        if (queue := self.queues.get(target_id)) is None:
+            queue = self.queues[target_id] = asyncio.Queue()
+            asyncio.create_task(self.work(queue), name=f"{self.name}-{target_id}")
+        queue.put_nowait(handle)
+
+    async def work(self, queue: asyncio.Queue) -> None:
+        while True:
+            handle = await queue.get()
+            try:
+                await handle()
+            except Exception:
+                self.logger.exception("Failed to handle event")
+
+    @property
+    def stats(self) -> dict:
+        return {"latency": self.latency, "zombies": self.zombies}
@@ -1,65 +1,73 @@
-import os
 import colorlog as cl
 import logging
-from typing import Protocol
+from typing import List, Protocol, Tuple
 
-from websocket import WebSocketApp as WSApp
+import aiohttp
 
-from bygeon.message import Message
+from bygeon.message import Attachment, Message
 
 logger_format = "%(log_color)s%(levelname)s: %(name)s: %(message)s"
 
 
-class Messenger(Protocol):
-    logger: logging.Logger
-
-    def get_logger(self):
+def get_logger(name: str) -> logging.Logger:
+    logger = cl.getLogger(name)
+    # several hubs can use the same messenger
+    if not logger.handlers:
         handler = cl.StreamHandler()
         handler.setFormatter(cl.ColoredFormatter(logger_format))
-
-        logger = cl.getLogger(self.name)
         logger.addHandler(handler)
         logger.setLevel(logging.DEBUG)
 
-        return logger
+    return logger
 
-    @property
-    def file_cache_path(self) -> str:
-        return os.path.join(os.getcwd(), "cache")
 
-    def generate_cache_path(self, hub_name: str) -> str:
-        return os.path.join(self.file_cache_path, hub_name)
+class DeliveryError(Exception):
+    # Raised by the send, modify and recall methods when the platform
+    # rejected the request, only retryable ones are tried again.
+    def __init__(self, message: str, retryable: bool = True) -> None:
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class Messenger(Protocol):
+    logger: logging.Logger
+    session: aiohttp.ClientSession
+
+    def get_logger(self):
+        return get_logger(self.name)
 
     @property
     def name(self) -> str:
         return self.__class__.__name__
 
-    def _on_open(self, ws) -> None:
-        self.logger.info("Opened WebSocket connection")
-
-    def _on_error(self, ws, e) -> None:
-        self.logger.error(f"WebSocket encountered error: {e}")
-
-    def _on_close(self, ws, close_status_code, close_msg) -> None:
-        self.logger.error(f"WebSocket closed: {close_msg}")
+    @property
+    def stats(self) -> dict:
+        return {}
 
-    def on_message(self, ws: WSApp, message: str) -> None:
-        ...
+    async def send_message(self, m: Message, ref_id=None) -> None: ...
 
-    def send_message(self, m: Message, ref_id=None) -> None:
-        ...
+    async def modify_message(self, m: Message, m_id: str) -> None: ...
 
-    def modify_message(self, m: Message, m_id: str) -> None:
-        ...
+    async def recall_message(self, message_id: str) -> None: ...
 
-    def recall_message(self, message_id: str) -> None:
-        ...
+    async def start(self) -> None: ...
 
-    def start(self) -> None:
-        ...
+    # opens what sending needs, before anything is relayed
+    def open(self) -> None: ...
 
-    def join(self) -> None:
-        ...
+    def split_links(
+        self, attachments: List[Attachment]
+    ) -> Tuple[List[str], List[Attachment]]:
+        # Lazy images are sent as links the platform shows inline, anything
+        # else has to be uploaded.
+        links: List[str] = []
+        files: List[Attachment] = []
+        for a in attachments:
+            if a.is_lazy and a.is_image and a.url:
+                links.append(a.url)
+            else:
+                files.append(a)
+        return links, files
 
     def cache_prefix(self, id="") -> str:
         return f"{self.name}_{id}."
@@ -0,0 +1,115 @@
+import asyncio
+import time
+from typing import Dict, Optional
+
+import aiohttp
+import orjson
+
+MAX_ATTEMPTS = 5
+
+
+class Bucket:
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        self.remaining: Optional[int] = None
+        self.reset_at = 0.0
+
+
+class RateLimiter:
+    # Tracks Discord's rate limit buckets from the X-RateLimit-* headers.
+    # Requests of the same bucket are queued behind its lock and wait for
+    # the reset instead of running into 429s.
+    def __init__(self) -> None:
+        # "<method> <route>" -> bucket hash reported by Discord
+        self.routes: Dict[str, str] = {}
+        self.buckets: Dict[str, Bucket] = {}
+        self.global_reset_at = 0.0
+        self.throttled = 0.0
+        self.rate_limited = 0
+
+    def get_bucket(self, route: str, major: str) -> Bucket:
+        key = f"{self.routes.get(route, route)}:{major}"
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = Bucket()
+        return bucket
+
+    async def throttle(self, until: float) -> None:
+        delay = until - time.monotonic()
+        if delay > 0:
+            self.throttled += delay
+            await asyncio.sleep(delay)
+
+    async def request(
+        self,
+        session: aiohttp.ClientSession,
+        method: str,
+        route: str,
+        major: str,
+        url: str,
+        **kwargs,
+    ) -> aiohttp.ClientResponse:
+        # The body is read before returning, so the response can be used
+        # after its connection went back to the pool. Form data can only be
+        # sent once, so it may be passed as a function building it instead.
+        route = f"{method} {route}"
+        data = kwargs.pop("data", None)
+        for _ in range(MAX_ATTEMPTS):
+            bucket = self.get_bucket(route, major)
+            async with bucket.lock:
+                await self.throttle(self.global_reset_at)
+                if bucket.remaining == 0:
+                    await self.throttle(bucket.reset_at)
+
+                if callable(data):
+                    kwargs["data"] = data()
+                elif data is not None:
+                    kwargs["data"] = data
+                async with session.request(method, url, **kwargs) as r:
+                    body = await r.read()
+                self.update(route, major, bucket, r, body)
+
+            if r.status != 429:
+                return r
+        return r
+
+    def update(
+        self,
+        route: str,
+        major: str,
+        bucket: Bucket,
+        r: aiohttp.ClientResponse,
+        body: bytes,
+    ) -> None:
+        now = time.monotonic()
+        headers = r.headers
+
+        if (bucket_hash := headers.get("X-RateLimit-Bucket")) is not None:
+            if self.routes.get(route) != bucket_hash:
+                self.routes[route] = bucket_hash
+                self.buckets.setdefault(f"{bucket_hash}:{major}", bucket)
+        if (remaining := headers.get("X-RateLimit-Remaining")) is not None:
+            bucket.remaining = int(remaining)
+        if (reset_after := headers.get("X-RateLimit-Reset-After")) is not None:
+            bucket.reset_at = now + float(reset_after)
+
+        if r.status == 429:
+            self.rate_limited += 1
+            try:
+                data = orjson.loads(body)
+            except orjson.JSONDecodeError:
+                data = {}
+            retry_after = float(data.get("retry_after", headers.get("Retry-After", 1)))
+            if data.get("global") or headers.get("X-RateLimit-Global") == "true":
+                self.global_reset_at = now + retry_after
+            else:
+                bucket.remaining = 0
+                bucket.reset_at = now + retry_after
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        return {
+            "throttled_seconds": self.throttled,
+            "rate_limited": self.rate_limited,
+            "buckets": len(self.buckets),
+        }
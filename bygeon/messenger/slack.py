@@ -1,23 +1,164 @@
-import threading
-from os.path import basename
-from typing import cast, List
+import asyncio
+from typing import cast, Dict, List, Optional, Tuple, Union
 
-from websocket import WebSocketApp as WSApp
-
-import requests
+import aiohttp
 import orjson
 
-import bygeon.util as util
+from bygeon.cache import LRUCache
 from bygeon.hub import Hub
 from bygeon.message import Message, Attachment
-from .messenger import Messenger
+from .messenger import Messenger, DeliveryError
+from .gateway import Gateway, PoolOptions, WS
 from .definition.slack import WSMessageType, EventType, MessageEventSubtype
 from .definition.slack import Endpoints, WSMessage, Event, MessageEvent, File
+from .definition.slack import UserChangeEvent, DisconnectReason
+
+USER_CACHE_SIZE = 10000
+# seconds
+USER_CACHE_TTL = 60 * 60
+# unknown users and bots are remembered as such for a shorter while
+NEGATIVE_TTL = 60
+# seconds between websocket pings
+PING_INTERVAL = 30
+# socket mode connections Slack allows per app
+MAX_CONNECTIONS = 10
+# seconds to wait for a replacement before closing a connection Slack is
+# about to drop
+ROTATE_TIMEOUT = 10
+# seconds to wait before each look for the message shared files ended up in
+SHARE_POLL_DELAYS = (0.5, 1, 2, 4)
+
+# ("user" or "bot", id) -> name, "" if it doesn't exist
+NameCache = LRUCache[Tuple[str, str], str]
+
+
+class SlackGateway(Gateway["Slack"]):
+    def __init__(self, app_token: str) -> None:
+        super().__init__(app_token)
+        self.app_token = app_token
+        # shared by every channel of the workspace
+        self.names: NameCache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+        self.lookups: Dict[Tuple[str, str], asyncio.Task] = {}
+        self.names_warmed = False
+        self.ping_interval = PING_INTERVAL
+        # Slack spreads the events over every connection of the app
+        self.connection_count = 1
+        self.connections: List[SlackGateway] = []
+        self.rotations = 0
+        self.ws: Optional[WS] = None
+        # set once Slack said hello on the connection
+        self.ready = asyncio.Event()
+        # set when Slack is about to drop the connection
+        self.refresh = asyncio.Event()
+
+    def _on_open(self, ws) -> None:
+        super()._on_open(ws)
+        self.ws = ws
+        self.ready.clear()
+
+    async def on_message(self, ws: WS, message: Union[str, bytes]) -> None:
+        self.logger.debug(message)
+        ws_message: WSMessage = orjson.loads(message)
+        ws_type = ws_message["type"]
+
+        match ws_type:
+            case WSMessageType.HELLO:
+                self.ready.set()
+            case WSMessageType.DISCONNECT:
+                reason = ws_message.get("reason")
+                # not reconnected, a replacement is opened instead
+                self.running = False
+                if reason == DisconnectReason.LINK_DISABLED:
+                    self.logger.error("Socket mode was disabled for the app")
+                    await ws.close()
+                else:
+                    self.logger.info(f"Slack is about to disconnect: {reason}")
+                    self.refresh.set()
+            case WSMessageType.EVENTS_API:
+                event = ws_message["payload"]["event"]
+                await self.send_ack(ws, ws_message)
+                if event["type"] == EventType.USER_CHANGE:
+                    # needs the users:read scope and the user_change event
+                    user = cast(UserChangeEvent, event)["user"]
+                    self.names.pop(("user", user["id"]))
+                    return None
+                channel = cast(MessageEvent, event).get("channel")
+                if (slack := self.subscribers.get(channel)) is not None:
+                    self.dispatch(channel, lambda: slack.handle_event(event))
+
+    async def connect(self) -> None:
+        async with self.session:
+            others = [self.sibling() for _ in range(1, self.connection_count)]
+            self.connections = [self] + others
+            await asyncio.gather(
+                *(self.keep_connected(i) for i in range(len(self.connections)))
+            )
+
+    def sibling(self) -> "SlackGateway":
+        # another connection of the app, sharing everything else
+        gateway = SlackGateway(self.app_token)
+        gateway.subscribers = self.subscribers
+        gateway.session = self.session
+        gateway.names = self.names
+        gateway.lookups = self.lookups
+        gateway.queues = self.queues
+        return gateway
+
+    async def keep_connected(self, i: int) -> None:
+        # Keeps the ith connection open. When Slack is about to drop it, a
+        # replacement is opened first, so no events are missed in between.
+        connection = self.connections[i]
+        task = asyncio.create_task(connection.run_websocket())
+        while True:
+            refresh = asyncio.create_task(connection.refresh.wait())
+            await asyncio.wait((task, refresh), return_when=asyncio.FIRST_COMPLETED)
+            if not connection.refresh.is_set():
+                # stopped for good
+                refresh.cancel()
+                return None
+            replacement = self.connections[i] = self.sibling()
+            replacement_task = asyncio.create_task(replacement.run_websocket())
+            try:
+                await asyncio.wait_for(replacement.ready.wait(), ROTATE_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.logger.warning("Replacement connection is not ready yet")
+            if connection.ws is not None:
+                await connection.ws.close()
+            await task
+            self.rotations += 1
+            connection, task = replacement, replacement_task
+
+    async def send_ack(self, ws: WS, message: WSMessage) -> None:
+        envelope_id = message["envelope_id"]
+        await ws.send_str(orjson.dumps({"envelope_id": envelope_id}).decode())
+
+    async def get_websocket_url(self) -> str:
+        header = get_headers(self.app_token)
+        async with self.session.post(Endpoints.CONNECTIONS_OPEN, headers=header) as r:
+            response = orjson.loads(await r.text())
+        self.logger.debug(response)
+
+        try:
+            websocket_url = response["url"]
+        except KeyError:
+            self.logger.error("Could not get websocket url")
+            raise Exception("Could not get websocket url")
+        else:
+            self.logger.info("Successfully got websocket url")
+
+        return websocket_url
 
 
 class Slack(Messenger):
     def __init__(
-        self, app_token: str, bot_token: str, channel_id: str, hub: Hub
+        self,
+        app_token: str,
+        bot_token: str,
+        channel_id: str,
+        hub: Hub,
+        pool: PoolOptions = PoolOptions(),
+        warm_user_cache: bool = False,
+        connections: int = 1,
     ) -> None:
 
         self.app_token = app_token
@@ -25,237 +166,325 @@ class Slack(Messenger):
         self.channel_id = channel_id
         self.hub = hub
         self.logger = self.get_logger()
+        self.bot_user_id: Optional[str] = None
+        self.warm_user_cache = warm_user_cache
 
-        self.bot_user_id = self.get_bot_user_id()
-
-    def on_open(self, ws) -> None:
-        self._on_open(ws)
-
-    def on_error(self, ws, e) -> None:
-        self._on_error(ws, e)
-
-    def on_close(self, ws, close_status_code, close_msg) -> None:
-        self._on_close(ws, close_status_code, close_msg)
+        self.gateway: SlackGateway = SlackGateway.get(app_token)
+        self.gateway.subscribe(channel_id, self, pool, warm_urls=(Endpoints.API_TEST,))
+        self.gateway.connection_count = min(
+            max(self.gateway.connection_count, connections), MAX_CONNECTIONS
+        )
 
-    def on_message(self, ws: WSApp, message: str) -> None:
-        self.logger.debug(message)
-        ws_message: WSMessage = orjson.loads(message)
-        ws_type = ws_message["type"]
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        return self.gateway.session
 
-        match ws_type:
-            case WSMessageType.HELLO:
-                return None
-            # FIXME
-            case WSMessageType.DISCONNECT:
-                self.logger.error("Disconnected")
-                self.logger.error("Trying to reconnect")
-                self.reconnect()
-            case WSMessageType.EVENTS_API:
-                event = ws_message["payload"]["event"]
-                self.send_ack(ws, ws_message)
-                self.handle_event(event)
+    @property
+    def stats(self) -> dict:
+        queue = self.gateway.queues.get(self.channel_id)
+        return {
+            "connections": [c.stats for c in self.gateway.connections],
+            "rotations": self.gateway.rotations,
+            "queued_events": 0 if queue is None else queue.qsize(),
+            "names": self.gateway.names.stats,
+        }
 
-    def handle_event(self, event: Event) -> None:
+    async def handle_event(self, event: Event) -> None:
         event_type = event["type"]
         match event_type:
             case EventType.MESSAGE:
                 event = cast(MessageEvent, event)
-                self.handle_message(event)
+                await self.handle_message(event)
             case _:
                 return None
 
-    def handle_message(self, event: MessageEvent) -> None:
+    async def handle_message(self, event: MessageEvent) -> None:
         # XXX
         subtype = event.get("subtype", "no_subtype")
         message_id = event["ts"]
         text = event["text"]
-        user_id = event.get("user")
-
-        if user_id is None:
-            username = event.get("username", "")
-        else:
-            username = self.get_username(user_id)
-
-        if user_id == self.bot_user_id:
-            return None
-
-        # XXX
-        username = cast(str, username)
 
         if event["channel"] != self.channel_id:
             return None
+        if event.get("user") == self.bot_user_id:
+            return None
 
         match subtype:
             case MessageEventSubtype.MESSAGE_DELETED:
                 deleted_ts = event["deleted_ts"]
                 self.logger.info("Deleted message: {}".format(deleted_ts))
-                self.hub.recall_message(self.name, deleted_ts)
+                await self.hub.recall_message(self.name, deleted_ts)
 
             case MessageEventSubtype.BOT_MESSAGE:
                 ...
 
             case MessageEventSubtype.NO_SUBTYPE:
-
+                username = await self.get_author(event)
                 m = Message(self.name, message_id, username, text, [])
                 if (ref_id := event.get("thread_ts")) is not None:
-                    self.hub.reply_message(m, ref_id)
+                    await self.hub.reply_message(m, ref_id)
                 else:
-                    self.hub.new_message(m)
+                    await self.hub.new_message(m)
             case MessageEventSubtype.FILE_SHARE:
-                attachments = self.get_attachments(event)
+                username = await self.get_author(event)
+                attachments = await self.get_attachments(event)
                 m = Message(self.name, message_id, username, text, attachments)
-                self.hub.new_message(m)
+                await self.hub.new_message(m)
             case MessageEventSubtype.MESSAGE_CHANGED:
                 self.logger.info(event)
+                username = await self.get_author(event)
                 m = Message(self.name, message_id, username, text, [])
-                self.hub.modify_message(m)
+                await self.hub.modify_message(m)
 
-    def get_attachments(self, event) -> list:
+    async def get_attachments(self, event) -> list:
         files: List[File] = event.get("files", [])
-        attachment = []
+        downloads = []
         for file in files:
+            self.logger.info("Downloading file: {}".format(file["name"]))
+            key = f"{self.name}:file:{file['id']}"
             fn = self.cache_prefix(file["id"]) + file["name"]
-            self.logger.info("Downloading file: {}".format(fn))
-            url = file["url_private_download"]
-            t = file["mimetype"]
-            path = self.generate_cache_path(self.hub.name)
-            file_path = util.download_to_cache(
-                url, path, fn, headers=self.get_headers(self.bot_token)
-            )
-            a = Attachment(fn, t, file_path)
-            attachment.append(a)
-        return attachment
-
-    def send_ack(self, ws: WSApp, message: WSMessage) -> None:
-        envelope_id = message["envelope_id"]
-        ws.send(orjson.dumps({"envelope_id": envelope_id}))
+            downloads.append((key, file["url_private_download"], fn, file["mimetype"]))
+        return await self.hub.attachments.download_all(
+            self.session, downloads, headers=self.get_headers(self.bot_token)
+        )
 
-    def get_username(self, id: str) -> str:
+    async def get_author(self, event: MessageEvent) -> str:
+        if (user_id := event.get("user")) is not None:
+            return await self.get_username(user_id)
+        if (username := event.get("username")) is not None:
+            return username
+        if (bot_id := event.get("bot_id")) is not None:
+            return await self.get_bot_name(bot_id)
+        return ""
+
+    async def get_username(self, id: str) -> str:
+        return await self.get_name("user", id, Endpoints.USERS_INFO)
+
+    async def get_bot_name(self, id: str) -> str:
+        return await self.get_name("bot", id, Endpoints.BOTS_INFO)
+
+    async def get_name(self, kind: str, id: str, url: str) -> str:
+        key = (kind, id)
+        if (name := self.gateway.names.get(key)) is not None:
+            return name
+        # messages of the same user arriving together share one request
+        lookups = self.gateway.lookups
+        if (task := lookups.get(key)) is None:
+            task = lookups[key] = asyncio.create_task(self.fetch_name(kind, id, url))
+            task.add_done_callback(lambda _: lookups.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def fetch_name(self, kind: str, id: str, url: str) -> str:
         headers = self.get_headers(self.bot_token)
-        r = requests.get(Endpoints.USERS_INFO + "?user=" + id, headers=headers)
-        response = orjson.loads(r.text)
-        self.logger.debug(r.text)
-        username = response["user"]["name"]
-        return username
-
-    def reconnect(self) -> None:
-        self.ws.close()
-        self.start()
-        self.join()
-
-    def get_websocket_url(self) -> str:
-        header = self.get_headers(self.app_token)
-        r = requests.post(Endpoints.CONNECTIONS_OPEN, headers=header)
-        response = orjson.loads(r.text)
-        self.logger.debug(response)
-
-        try:
-            websocket_url = response["url"]
-        except KeyError:
-            self.logger.error("Could not get websocket url")
-            raise Exception("Could not get websocket url")
-        else:
-            self.logger.info("Successfully got websocket url")
-
-        return websocket_url
+        async with self.session.get(url, params={kind: id}, headers=headers) as r:
+            text = await r.text()
+        response = orjson.loads(text)
+        self.logger.debug(text)
+        if not response["ok"]:
+            self.logger.warning(f"Could not look up {kind} {id}: {response}")
+            self.gateway.names.put((kind, id), "", ttl=NEGATIVE_TTL)
+            return ""
+        name = response[kind]["name"]
+        self.gateway.names.put((kind, id), name)
+        return name
+
+    async def warm_up_names(self) -> None:
+        headers = self.get_headers(self.bot_token)
+        params = {"limit": 200}
+        while True:
+            async with self.session.get(
+                Endpoints.USERS_LIST, params=params, headers=headers
+            ) as r:
+                response = orjson.loads(await r.text())
+            if not response["ok"]:
+                self.logger.warning(f"Could not list users: {response}")
+                return None
+            for user in response["members"]:
+                self.gateway.names.put(("user", user["id"]), user["name"])
+            cursor = response.get("response_metadata", {}).get("next_cursor")
+            if not cursor:
+                break
+            params["cursor"] = cursor
+        self.logger.info(f"Cached {len(self.gateway.names)} user names")
+
+    async def send_message(self, m: Message, ref_id=None) -> None:
+        links, attachments = self.split_links(m.attachments)
+        text = "\n".join([m.text, *links])
+        attachments = await self.hub.attachments.resolve_all(self.session, attachments)
+        self.logger.info("Sending message: {}".format(m.text))
+        if len(attachments) != 0:
+            # the files are shared with the text as a single message, which
+            # can't be posted under another name though
+            comment = f"[{m.author_username}]: {text}"
+            ts = await self.upload_files(attachments, comment, ref_id)
+            self.hub.update_entry(m, self.name, ts)
+            return None
 
-    def send_message(self, m: Message, ref_id=None) -> None:
         payload = {
             "type": "message",
             "username": m.author_username,
             "channel": self.channel_id,
-            "text": m.text,
+            "text": text,
         }
         if ref_id is not None:
             payload["thread_ts"] = ref_id
-        if len(m.attachments) != 0:
-            payload["initial_comment"] = m.text
-            self.upload_files(m)
-        self.logger.info("Sending message: {}".format(m.text))
-        r = requests.post(
+        async with self.session.post(
             Endpoints.POST_MESSAGE,
             json=payload,
             headers=self.get_headers(self.bot_token),
-        )
-        response = orjson.loads(r.text)
-        if not response["ok"]:
-            self.logger.error(response)
-        else:
-            self.hub.update_entry(m, self.name, response.get("ts"))
-
-    # return last id as message id
-    def upload_files(self, m: Message) -> None:
-        payload = {"channels": self.channel_id}
-
-        attachments = m.attachments
-
-        headers = self.get_headers(self.bot_token)
-        headers.pop("Content-Type")
-        for attachment in attachments:
-            fn = basename(attachment.file_path)
-            a_type = attachment.type
-            file = {"file": (fn, open(attachment.file_path, "rb"), a_type)}
-            self.logger.info(attachment.file_path)
-            r = requests.post(
-                Endpoints.FILE_UPLOAD,
-                headers=headers,
-                data=payload,
-                files=file,
+        ) as r:
+            response = await check_response(r)
+        self.hub.update_entry(m, self.name, response.get("ts"))
+
+    async def upload_files(
+        self, attachments: List[Attachment], comment: str, ref_id=None
+    ) -> Optional[str]:
+        # Uploads every file at once, then shares them all in one message
+        # and returns its ts.
+        file_ids = await asyncio.gather(*(self.upload_file(a) for a in attachments))
+        files = [
+            {"id": file_id, "title": a.name}
+            for file_id, a in zip(file_ids, attachments)
+        ]
+        payload = {
+            "files": orjson.dumps(files).decode(),
+            "channel_id": self.channel_id,
+            "initial_comment": comment,
+        }
+        if ref_id is not None:
+            payload["thread_ts"] = ref_id
+        async with self.session.post(
+            Endpoints.COMPLETE_UPLOAD,
+            data=payload,
+            headers=self.get_form_headers(self.bot_token),
+        ) as r:
+            response = await check_response(r)
+
+        ts = self.get_share_ts(response["files"][0])
+        # shares are filled in asynchronously, they may be missing here
+        for delay in SHARE_POLL_DELAYS:
+            if ts is not None:
+                break
+            await asyncio.sleep(delay)
+            async with self.session.get(
+                Endpoints.FILES_INFO,
+                params={"file": file_ids[0]},
+                headers=self.get_headers(self.bot_token),
+            ) as r:
+                response = await check_response(r)
+            ts = self.get_share_ts(response["file"])
+        if ts is None:
+            self.logger.warning(
+                f"Could not find the message of file {file_ids[0]}, replies, "
+                "edits and recalls of it won't be relayed"
             )
-            response = orjson.loads(r.text)
-            if not response["ok"]:
-                self.logger.error(response)
-
-    def recall_message(self, message_id: str) -> None:
+        return ts
+
+    async def upload_file(self, attachment: Attachment) -> str:
+        content = attachment.read()
+        params = {"filename": attachment.filename, "length": str(len(content))}
+        self.logger.info(attachment.filename)
+        async with self.session.post(
+            Endpoints.GET_UPLOAD_URL,
+            data=params,
+            headers=self.get_form_headers(self.bot_token),
+        ) as r:
+            response = await check_response(r)
+        async with self.session.post(
+            response["upload_url"],
+            data=content,
+            headers={"Content-Type": attachment.type},
+        ) as r:
+            if r.status >= 400:
+                raise DeliveryError(
+                    f"{r.status}: {await r.text()}", retryable=r.status >= 500
+                )
+        return response["file_id"]
+
+    def get_share_ts(self, file: dict) -> Optional[str]:
+        shares = file.get("shares", {})
+        for channels in (shares.get("public", {}), shares.get("private", {})):
+            if (channel_shares := channels.get(self.channel_id)) is not None:
+                return channel_shares[0]["ts"]
+        return None
+
+    async def recall_message(self, message_id: str) -> None:
         payload = {
             "token": self.bot_token,
             "channel": self.channel_id,
             "ts": message_id,
         }
-        r = requests.post(
+        async with self.session.post(
             Endpoints.CHAT_DELETE,
             json=payload,
             headers=self.get_headers(self.bot_token),
-        )
-        self.logger.info("Trying to recall: " + message_id)
+        ) as r:
+            await check_response(r)
+        self.logger.info("Recalled: " + message_id)
 
-    def modify_message(self, m: Message, m_id: str) -> None:
+    async def modify_message(self, m: Message, m_id: str) -> None:
         payload = {
             "token": self.bot_token,
             "channel": self.channel_id,
             "ts": m_id,
             "text": m.text,
         }
-        requests.post(
+        async with self.session.post(
             Endpoints.CHAT_UPDATE,
             json=payload,
             headers=self.get_headers(self.bot_token),
-        )
+        ) as r:
+            await check_response(r)
 
-    def start(self) -> None:
-        self.ws = WSApp(
-            self.get_websocket_url(),
-            on_open=self.on_open,
-            on_message=self.on_message,
-            on_error=self.on_error,
-            on_close=self.on_close,
-        )
-        self.thread = threading.Thread(target=self.ws.run_forever)
-        self.thread.daemon = True
-        self.thread.start()
+    def open(self) -> None:
+        self.gateway.open()
+
+    async def start(self) -> None:
+        self.gateway.open()
+        self.bot_user_id = await self.get_bot_user_id()
+        if self.warm_user_cache and not self.gateway.names_warmed:
+            self.gateway.names_warmed = True
+            asyncio.create_task(self.warm_up_names())
+        await self.gateway.run()
 
-    def get_bot_user_id(self) -> str:
+    async def get_bot_user_id(self) -> str:
         headers = self.get_headers(self.bot_token)
 
-        r = requests.get(Endpoints.AUTH_TEST, headers=headers)
-        bot_info = orjson.loads(r.text)
+        async with self.session.get(Endpoints.AUTH_TEST, headers=headers) as r:
+            bot_info = orjson.loads(await r.text())
         return bot_info["user_id"]
 
     def get_headers(self, token) -> dict:
-        return {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer " + token,
-        }
+        return get_headers(token)
 
-    def join(self) -> None:
-        self.thread.join()
+    def get_form_headers(self, token) -> dict:
+        headers = get_headers(token)
+        headers.pop("Content-Type")
+        return headers
+
+
+def get_headers(token) -> dict:
+    return {
+        "Content-Type": "application/json",
+        "Authorization": "Bearer " + token,
+    }
+
+
+# errors worth trying again later, anything else is a bad request
+RETRYABLE_ERRORS = {
+    "ratelimited",
+    "internal_error",
+    "fatal_error",
+    "service_unavailable",
+    "request_timeout",
+}
+
+
+async def check_response(r: aiohttp.ClientResponse) -> dict:
+    if r.status == 429 or r.status >= 500:
+        raise DeliveryError(f"{r.status}: {await r.text()}")
+    response = orjson.loads(await r.read())
+    if not response["ok"]:
+        error = response.get("error", "")
+        raise DeliveryError(str(response), retryable=error in RETRYABLE_ERRORS)
+    return response
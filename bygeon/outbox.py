@@ -0,0 +1,189 @@
+import asyncio
+import random
+import sqlite3
+import time
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+import aiohttp
+import orjson
+
+from .breaker import CircuitBreaker
+from .message import Attachment, Message
+from .messenger.messenger import DeliveryError, get_logger
+from .store import MessageStore, NativeId
+
+logger = get_logger(__name__)
+
+
+class OperationKind:
+    SEND = "send"
+    MODIFY = "modify"
+    RECALL = "recall"
+
+
+class Operation(NamedTuple):
+    kind: str
+    # the message on its origin messenger, for recalls that is all there is
+    origin: str
+    origin_id: NativeId
+    message: Optional[Message] = None
+    # origin id of the message replied to
+    reply_to: Optional[NativeId] = None
+
+
+def encode_operation(operation: Operation) -> bytes:
+    data: dict = operation._asdict()
+    if (m := operation.message) is not None:
+        data["message"] = m._asdict()
+        # attachments only held in memory can't be replayed
+        data["message"]["attachments"] = [
+            a._asdict() for a in m.attachments if a.content is None
+        ]
+    return orjson.dumps(data)
+
+
+def decode_operation(data: bytes) -> Operation:
+    operation = orjson.loads(data)
+    if (m := operation["message"]) is not None:
+        m["attachments"] = [Attachment(**a) for a in m["attachments"]]
+        operation["message"] = Message(**m)
+    return Operation(**operation)
+
+
+def is_retryable(e: Exception) -> bool:
+    if isinstance(e, DeliveryError):
+        return e.retryable
+    return isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError, OSError))
+
+
+class Outbox:
+    # Every outbound operation is written to the outbox table before it is
+    # attempted and deleted once it went through, so whatever is still in
+    # there after a restart is replayed.
+    def __init__(
+        self,
+        store: MessageStore,
+        max_attempts: int = 8,
+        base_delay: float = 1,
+        max_delay: float = 300,
+    ) -> None:
+        self.store = store
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retried = 0
+        self.dropped = 0
+
+    async def record(self, entries: List[Tuple[str, Operation]]) -> List[int]:
+        rows = [(messenger, encode_operation(op)) for messenger, op in entries]
+        created_at = time.time()
+        ids: List[int] = []
+
+        def op(con: sqlite3.Connection) -> None:
+            for messenger, operation in rows:
+                cur = con.execute(
+                    'INSERT INTO "outbox" ("messenger", "operation", "created_at") VALUES (?, ?, ?)',
+                    (messenger, operation, created_at),
+                )
+                ids.append(cur.lastrowid)
+
+        await self.store.execute_async(op)
+        return ids
+
+    def pending(
+        self, messenger: str, first: int, last: int, limit: int
+    ) -> List[Tuple[int, Operation]]:
+        cur = self.store.reader.execute(
+            """
+            SELECT "id", "operation" FROM "outbox"
+            WHERE "messenger" = ? AND "id" BETWEEN ? AND ?
+            ORDER BY "id" LIMIT ?
+            """,
+            (messenger, first, last, limit),
+        )
+        return [(i, decode_operation(data)) for i, data in cur]
+
+    def pending_ranges(self) -> Dict[str, Tuple[int, int]]:
+        cur = self.store.reader.execute(
+            'SELECT "messenger", min("id"), max("id") FROM "outbox" GROUP BY "messenger"'
+        )
+        return {m: (first, last) for m, first, last in cur}
+
+    def referenced_files(self) -> Set[str]:
+        # attachments that still have to be sent
+        files = set()
+        cur = self.store.reader.execute('SELECT "operation" FROM "outbox"')
+        for (data,) in cur:
+            if (m := decode_operation(data).message) is not None:
+                files.update(a.file_path for a in m.attachments)
+        return files
+
+    def remove(self, entry_id: int) -> None:
+        def op(con: sqlite3.Connection) -> None:
+            con.execute('DELETE FROM "outbox" WHERE "id" = ?', (entry_id,))
+
+        self.store.submit(op)
+
+    def add_attempt(self, entry_id: int) -> None:
+        def op(con: sqlite3.Connection) -> None:
+            con.execute(
+                'UPDATE "outbox" SET "attempts" = "attempts" + 1 WHERE "id" = ?',
+                (entry_id,),
+            )
+
+        self.store.submit(op)
+
+    def backoff(self, attempt: int) -> float:
+        # exponential with full jitter, so destinations recovering from an
+        # outage aren't hit by every hub at the same moment
+        delay = min(self.max_delay, self.base_delay * 2**attempt)
+        return random.uniform(0, delay)
+
+    async def deliver(
+        self,
+        entry_id: int,
+        send: Callable[[], Awaitable[None]],
+        breaker: CircuitBreaker,
+    ) -> None:
+        # Retries in place, so later operations for the same destination
+        # keep waiting behind this one and stay in order.
+        attempt = 0
+        while True:
+            await breaker.acquire()
+            try:
+                await send()
+            except Exception as e:
+                retryable = is_retryable(e)
+                # rejected requests still mean the destination is up
+                if retryable:
+                    breaker.failure()
+                else:
+                    breaker.success()
+                attempt += 1
+                if not retryable or attempt >= self.max_attempts:
+                    logger.exception("Dropping outbox entry %d", entry_id)
+                    self.dropped += 1
+                    break
+                delay = self.backoff(attempt)
+                logger.warning(
+                    "Outbox entry %d failed (%s), retrying in %.1fs", entry_id, e, delay
+                )
+                self.retried += 1
+                self.add_attempt(entry_id)
+                await asyncio.sleep(delay)
+            else:
+                breaker.success()
+                break
+        self.remove(entry_id)
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        depth, oldest = self.store.reader.execute(
+            'SELECT count(*), min("created_at") FROM "outbox"'
+        ).fetchone()
+        return {
+            "depth": depth,
+            "oldest_age": 0 if oldest is None else time.time() - oldest,
+            "retried": self.retried,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,123 @@
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from .messenger.messenger import get_logger
+from .outbox import Outbox
+from .store import MessageStore
+
+logger = get_logger(__name__)
+
+
+class Retention:
+    def __init__(
+        self,
+        store: MessageStore,
+        cache_path: str,
+        max_age: Optional[float] = None,
+        max_rows: Optional[int] = None,
+        max_cache_size: Optional[int] = None,
+        batch_size: int = 500,
+        interval: float = 300,
+        pause: float = 0.1,
+        vacuum_pages: int = 256,
+        outbox: Optional[Outbox] = None,
+    ) -> None:
+        self.store = store
+        self.cache_path = cache_path
+        self.max_age = max_age
+        self.max_rows = max_rows
+        self.max_cache_size = max_cache_size
+        self.outbox = outbox
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pause = pause
+        self.vacuum_pages = vacuum_pages
+        self.cache_bytes = 0
+        self.evicted = 0
+
+    @property
+    def enabled(self) -> bool:
+        return (
+            self.max_age is not None
+            or self.max_rows is not None
+            or self.max_cache_size is not None
+        )
+
+    def start(self) -> None:
+        if not self.enabled:
+            return None
+        self.thread = threading.Thread(
+            target=self.run, name=f"{self.store.path}-retention", daemon=True
+        )
+        self.thread.start()
+
+    def run(self) -> None:
+        while True:
+            try:
+                self.prune()
+            except Exception:
+                logger.exception("Failed to prune %s", self.store.path)
+            time.sleep(self.interval)
+
+    def prune(self) -> None:
+        # Small batches keep the writer free for new mappings in between.
+        if self.max_age is not None or self.max_rows is not None:
+            while (
+                self.store.prune(
+                    self.max_age, self.max_rows, self.batch_size, self.vacuum_pages
+                )
+                == self.batch_size
+            ):
+                time.sleep(self.pause)
+
+        self.prune_files()
+
+    def prune_files(self) -> None:
+        # Removes files older than max_age, then the least recently used
+        # ones until the cache fits into max_cache_size. Cache hits touch
+        # their file, so its mtime is when it was last used.
+        if not os.path.isdir(self.cache_path):
+            return None
+        files = []
+        with os.scandir(self.cache_path) as it:
+            for entry in it:
+                if entry.is_file():
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+        self.cache_bytes = sum(size for _, size, _ in files)
+
+        # files of sends that are still pending are never removed
+        pinned = self.outbox.referenced_files() if self.outbox is not None else set()
+        cutoff = time.time() - self.max_age if self.max_age is not None else None
+        removed = []
+        for mtime, size, path in files:
+            expired = cutoff is not None and mtime < cutoff
+            oversized = (
+                self.max_cache_size is not None
+                and self.cache_bytes > self.max_cache_size
+            )
+            if not expired and not oversized:
+                break
+            if path in pinned:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            self.cache_bytes -= size
+            removed.append(os.path.basename(path))
+            if len(removed) % self.batch_size == 0:
+                time.sleep(self.pause)
+        self.evicted += len(removed)
+
+        # the ids of the removed files would otherwise stay forever
+        for i in range(0, len(removed), self.batch_size):
+            self.store.remove_blobs(removed[i : i + self.batch_size], self.vacuum_pages)
+            time.sleep(self.pause)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {"cache_bytes": self.cache_bytes, "evicted": self.evicted}
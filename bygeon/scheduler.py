@@ -0,0 +1,80 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from .messenger.messenger import get_logger
+
+logger = get_logger(__name__)
+
+Task = Tuple[Callable[..., Awaitable[None]], tuple]
+
+
+class WorkerPool:
+    def __init__(
+        self, name: str, workers: int = 4, queue_size: int = 256, ordered=True
+    ) -> None:
+        self.name = name
+        # a single worker runs the tasks strictly in the order they came in
+        self.workers = 1 if ordered else workers
+        # Holds at most queue_size tasks, the hub checks free before
+        # submitting and parks what doesn't fit in the outbox instead.
+        self.queue: "asyncio.Queue[Task]" = asyncio.Queue(maxsize=queue_size)
+        self.tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        self.tasks = [
+            asyncio.create_task(self.work(), name=f"{self.name}-{i}")
+            for i in range(self.workers)
+        ]
+
+    def submit_nowait(self, func: Callable[..., Awaitable[None]], args: tuple) -> None:
+        self.queue.put_nowait((func, args))
+
+    @property
+    def free(self) -> int:
+        return self.queue.maxsize - self.queue.qsize()
+
+    async def work(self) -> None:
+        while True:
+            func, args = await self.queue.get()
+            try:
+                await func(*args)
+            except Exception:
+                logger.exception("Task failed in %s", self.name)
+            finally:
+                self.queue.task_done()
+
+
+class Scheduler:
+    def __init__(
+        self, name: str, workers: int = 4, queue_size: int = 256, ordered=True
+    ) -> None:
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self.ordered = ordered
+        self.pools: Dict[str, WorkerPool] = {}
+
+    def add_destination(self, destination: str) -> None:
+        if destination not in self.pools:
+            self.pools[destination] = WorkerPool(
+                f"{self.name}-{destination}",
+                self.workers,
+                self.queue_size,
+                self.ordered,
+            )
+
+    def start(self) -> None:
+        for pool in self.pools.values():
+            pool.start()
+
+    def submit_nowait(
+        self, destination: str, func: Callable[..., Awaitable[None]], args: tuple
+    ) -> None:
+        self.pools[destination].submit_nowait(func, args)
+
+    def free(self, destination: str) -> int:
+        return self.pools[destination].free
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {name: pool.queue.qsize() for name, pool in self.pools.items()}
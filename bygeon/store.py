@@ -0,0 +1,479 @@
+import asyncio
+import queue
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from .cache import LRUCache
+from .messenger.messenger import get_logger
+
+NativeId = Union[int, str]
+
+MIN_INTEGER_ID = -(2**63)
+MAX_INTEGER_ID = 2**63 - 1
+
+SYNCHRONOUS_LEVELS = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+WriteOperation = Callable[[sqlite3.Connection], None]
+
+# The callback, if any, is called by the writer once the operation is
+# committed, or with the error if it couldn't be.
+Done = Callable[[Optional[Exception]], None]
+Write = Tuple[WriteOperation, Optional[Done]]
+
+# every key of a message shares the same dict of its ids
+MappingCache = LRUCache[Tuple[str, str], Dict[str, str]]
+
+logger = get_logger(__name__)
+
+
+def encode_id(native_id: NativeId) -> NativeId:
+    # Discord snowflakes and CQHttp ids, which can be negative, are stored
+    # as 64-bit integers however they arrive, anything else (e.g. Slack
+    # timestamps) is kept as text.
+    if isinstance(native_id, int):
+        return native_id
+    native_id = str(native_id)
+    digits = native_id.removeprefix("-")
+    if digits.isascii() and digits.isdigit():
+        value = int(native_id)
+        if MIN_INTEGER_ID <= value <= MAX_INTEGER_ID and str(value) == native_id:
+            return value
+    return native_id
+
+
+def decode_id(native_id: NativeId) -> str:
+    return str(native_id)
+
+
+class MessageStore:
+    def __init__(
+        self,
+        path: str,
+        synchronous: str = "NORMAL",
+        batch_size: int = 256,
+        batch_interval: float = 0.02,
+        cache_size: int = 4096,
+        cache_ttl: Optional[float] = 6 * 60 * 60,
+    ) -> None:
+        synchronous = synchronous.upper()
+        if synchronous not in SYNCHRONOUS_LEVELS:
+            raise ValueError(f"Invalid synchronous level: {synchronous}")
+
+        self.path = path
+        self.synchronous = synchronous
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.cache: MappingCache = LRUCache(cache_size, cache_ttl)
+        self.vacuum_pages = 0
+
+        # Only the writer thread uses this connection once migrations are done,
+        # every other thread reads through its own connection.
+        self.con = self.connect()
+        self.con.execute("PRAGMA journal_mode = WAL")
+        self.migrate()
+
+        self.local = threading.local()
+        self.queue: "queue.Queue[Optional[Write]]" = queue.Queue()
+        self.writer = threading.Thread(
+            target=self.write_loop, name=f"{path}-writer", daemon=True
+        )
+        self.writer.start()
+
+    def connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        con.execute(f"PRAGMA synchronous = {self.synchronous}")
+        return con
+
+    @property
+    def reader(self) -> sqlite3.Connection:
+        con = getattr(self.local, "con", None)
+        if con is None:
+            con = self.local.con = self.connect()
+        return con
+
+    def submit(self, op: WriteOperation, done: Optional[Done] = None) -> None:
+        self.queue.put((op, done))
+
+    def execute(self, op: WriteOperation) -> None:
+        committed = threading.Event()
+        errors: List[Exception] = []
+
+        def done(error: Optional[Exception]) -> None:
+            if error is not None:
+                errors.append(error)
+            committed.set()
+
+        self.submit(op, done)
+        committed.wait()
+        if errors:
+            raise errors[0]
+
+    async def execute_async(self, op: WriteOperation) -> None:
+        # Like execute, but waits without blocking the event loop.
+        loop = asyncio.get_running_loop()
+        committed = loop.create_future()
+
+        def set_result(error: Optional[Exception]) -> None:
+            if committed.done():
+                return None
+            if error is not None:
+                committed.set_exception(error)
+            else:
+                committed.set_result(None)
+
+        def done(error: Optional[Exception]) -> None:
+            # nobody is waiting anymore once the loop stopped
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(set_result, error)
+
+        self.submit(op, done)
+        await committed
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.writer.join()
+
+    def write_loop(self) -> None:
+        running = True
+        while running:
+            batch: List[Write] = []
+            write = self.queue.get()
+            deadline = time.monotonic() + self.batch_interval
+            while write is not None:
+                batch.append(write)
+                timeout = deadline - time.monotonic()
+                if len(batch) >= self.batch_size or timeout <= 0:
+                    break
+                try:
+                    write = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            else:
+                running = False
+            if len(batch) > 0:
+                self.commit(batch)
+
+    def commit(self, batch: List[Write]) -> None:
+        # One transaction, and therefore one fsync, for the whole batch. No
+        # error may escape, or the writer thread dies and every caller of
+        # execute waits forever.
+        con = self.con
+        errors: List[Optional[Exception]] = [None] * len(batch)
+        try:
+            con.execute("BEGIN")
+            for i, (op, _) in enumerate(batch):
+                try:
+                    op(con)
+                except Exception as e:
+                    logger.exception("Failed to write to %s", self.path)
+                    errors[i] = e
+            con.execute("COMMIT")
+        except Exception as e:
+            # e.g. a full disk, nothing of the batch was written
+            logger.exception("Failed to commit to %s", self.path)
+            errors = [e] * len(batch)
+            if con.in_transaction:
+                try:
+                    con.execute("ROLLBACK")
+                except sqlite3.Error:
+                    logger.exception("Failed to roll back %s", self.path)
+
+        if self.vacuum_pages > 0:
+            # executescript steps the pragma to completion, but it would also
+            # commit an open transaction, so it has to run after the batch.
+            try:
+                con.executescript(f"PRAGMA incremental_vacuum({self.vacuum_pages})")
+            except sqlite3.Error:
+                logger.exception("Failed to vacuum %s", self.path)
+            self.vacuum_pages = 0
+
+        for (_, done), error in zip(batch, errors):
+            if done is not None:
+                try:
+                    done(error)
+                except Exception:
+                    logger.exception("Failed to complete a write")
+
+    def migrate(self) -> None:
+        version = self.con.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            self.migrate_v1()
+        if version < 2:
+            self.migrate_v2()
+        if version < 3:
+            self.migrate_v3()
+        if version < 4:
+            self.migrate_v4()
+        if version < 5:
+            self.migrate_v5()
+
+    def migrate_v1(self) -> None:
+        # Converts the wide table of the previous versions, which had one
+        # column per messenger, into the normalized mapping table.
+        con = self.con
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            legacy = (
+                con.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages'"
+                ).fetchone()
+                is not None
+            )
+            if legacy:
+                con.execute('ALTER TABLE "messages" RENAME TO "legacy_messages"')
+
+            con.execute("""
+                CREATE TABLE "messages" (
+                    "id" INTEGER PRIMARY KEY,
+                    "created_at" INTEGER NOT NULL
+                )
+                """)
+            # WITHOUT ROWID makes the primary key a clustered index, so
+            # lookups by (messenger, native_id) never touch another b-tree.
+            con.execute("""
+                CREATE TABLE "mappings" (
+                    "messenger" TEXT NOT NULL,
+                    "native_id" NOT NULL,
+                    "canonical_id" INTEGER NOT NULL,
+                    PRIMARY KEY ("messenger", "native_id")
+                ) WITHOUT ROWID
+                """)
+            con.execute(
+                'CREATE INDEX "mappings_canonical_id" ON "mappings" ("canonical_id")'
+            )
+
+            if legacy:
+                self.copy_legacy_messages()
+                con.execute('DROP TABLE "legacy_messages"')
+
+            con.execute("PRAGMA user_version = 1")
+            con.execute("COMMIT")
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+
+    def migrate_v2(self) -> None:
+        # Lets retention give pages back to the file system incrementally,
+        # changing auto_vacuum on an existing database needs a full VACUUM.
+        self.con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.con.execute("VACUUM")
+        self.con.execute("PRAGMA user_version = 2")
+
+    def migrate_v3(self) -> None:
+        # Outbound operations waiting to be delivered, see bygeon.outbox.
+        con = self.con
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            con.execute("""
+                CREATE TABLE "outbox" (
+                    "id" INTEGER PRIMARY KEY,
+                    "messenger" TEXT NOT NULL,
+                    "operation" BLOB NOT NULL,
+                    "attempts" INTEGER NOT NULL DEFAULT 0,
+                    "created_at" REAL NOT NULL
+                )
+                """)
+            con.execute("PRAGMA user_version = 3")
+            con.execute("COMMIT")
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+
+    def migrate_v4(self) -> None:
+        # Downloaded files by their id on the platform, see bygeon.attachments.
+        con = self.con
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            con.execute("""
+                CREATE TABLE "blobs" (
+                    "key" TEXT PRIMARY KEY,
+                    "blob" TEXT NOT NULL
+                ) WITHOUT ROWID
+                """)
+            con.execute("PRAGMA user_version = 4")
+            con.execute("COMMIT")
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+
+    def migrate_v5(self) -> None:
+        # Negative ids used to be kept as text, which never equals the
+        # integer they are looked up by now.
+        con = self.con
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            con.execute("""
+                UPDATE OR IGNORE "mappings"
+                SET "native_id" = CAST("native_id" AS INTEGER)
+                WHERE typeof("native_id") = 'text'
+                AND "native_id" GLOB '-[1-9]*'
+                AND CAST(CAST("native_id" AS INTEGER) AS TEXT) = "native_id"
+                """)
+            con.execute("PRAGMA user_version = 5")
+            con.execute("COMMIT")
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+
+    def copy_legacy_messages(self) -> None:
+        cur = self.con.execute('SELECT * FROM "legacy_messages"')
+        messengers = [d[0] for d in cur.description]
+        now = int(time.time())
+        for row in cur.fetchall():
+            ids = [
+                (messenger, native_id)
+                for messenger, native_id in zip(messengers, row)
+                if native_id is not None and native_id != "None"
+            ]
+            if len(ids) == 0:
+                continue
+            canonical_id = self.con.execute(
+                'INSERT INTO "messages" ("created_at") VALUES (?)', (now,)
+            ).lastrowid
+            self.con.executemany(
+                'INSERT OR IGNORE INTO "mappings" VALUES (?, ?, ?)',
+                ((m, encode_id(i), canonical_id) for m, i in ids),
+            )
+
+    def add(self, messenger: str, native_id: NativeId) -> None:
+        key = (messenger, decode_id(native_id))
+        if self.cache.peek(key) is None:
+            self.cache.put(key, {messenger: key[1]})
+
+        native_id = encode_id(native_id)
+        created_at = int(time.time())
+
+        def op(con: sqlite3.Connection) -> None:
+            exists = con.execute(
+                'SELECT 1 FROM "mappings" WHERE "messenger" = ? AND "native_id" = ?',
+                (messenger, native_id),
+            ).fetchone()
+            if exists is None:
+                canonical_id = con.execute(
+                    'INSERT INTO "messages" ("created_at") VALUES (?)',
+                    (created_at,),
+                ).lastrowid
+                con.execute(
+                    'INSERT INTO "mappings" VALUES (?, ?, ?)',
+                    (messenger, native_id, canonical_id),
+                )
+
+        self.submit(op)
+
+    def link(
+        self,
+        origin: str,
+        origin_id: NativeId,
+        messenger: str,
+        native_id: NativeId,
+    ) -> None:
+        if (cached := self.cache.peek((origin, decode_id(origin_id)))) is not None:
+            ids = cached[0]
+            ids[messenger] = decode_id(native_id)
+            self.cache.put((messenger, ids[messenger]), ids)
+
+        params = (messenger, encode_id(native_id), origin, encode_id(origin_id))
+
+        def op(con: sqlite3.Connection) -> None:
+            con.execute(
+                """
+                INSERT OR REPLACE INTO "mappings"
+                SELECT ?, ?, "canonical_id" FROM "mappings"
+                WHERE "messenger" = ? AND "native_id" = ?
+                """,
+                params,
+            )
+
+        self.submit(op)
+
+    def lookup(self, messenger: str, native_id: NativeId) -> Dict[str, str]:
+        key = (messenger, decode_id(native_id))
+        if (ids := self.cache.get(key)) is not None:
+            return dict(ids)
+
+        cur = self.reader.execute(
+            """
+            SELECT m."messenger", m."native_id"
+            FROM "mappings" AS o
+            JOIN "mappings" AS m ON m."canonical_id" = o."canonical_id"
+            WHERE o."messenger" = ? AND o."native_id" = ?
+            """,
+            (messenger, encode_id(native_id)),
+        )
+        ids = {m: decode_id(i) for m, i in cur}
+        for item in ids.items():
+            self.cache.put(item, ids)
+        return dict(ids)
+
+    def prune(
+        self,
+        max_age: Optional[float],
+        max_rows: Optional[int],
+        limit: int,
+        vacuum_pages: int = 0,
+    ) -> int:
+        # Deletes at most limit of the oldest messages that are older than
+        # max_age or not among the newest max_rows, returns how many it did.
+        pruned: List[int] = []
+
+        def op(con: sqlite3.Connection) -> None:
+            ids = set()
+            if max_age is not None:
+                cutoff = int(time.time() - max_age)
+                cur = con.execute(
+                    'SELECT "id" FROM "messages" WHERE "created_at" < ? ORDER BY "id" LIMIT ?',
+                    (cutoff, limit),
+                )
+                ids.update(row[0] for row in cur)
+            if max_rows is not None:
+                cur = con.execute(
+                    """
+                    SELECT "id" FROM "messages" WHERE "id" <= (
+                        SELECT "id" FROM "messages" ORDER BY "id" DESC LIMIT 1 OFFSET ?
+                    ) ORDER BY "id" LIMIT ?
+                    """,
+                    (max_rows, limit),
+                )
+                ids.update(row[0] for row in cur)
+            pruned.extend(sorted(ids)[:limit])
+
+            for canonical_id in pruned:
+                cur = con.execute(
+                    'SELECT "messenger", "native_id" FROM "mappings" WHERE "canonical_id" = ?',
+                    (canonical_id,),
+                )
+                for m, native_id in cur.fetchall():
+                    self.cache.pop((m, decode_id(native_id)))
+                con.execute(
+                    'DELETE FROM "mappings" WHERE "canonical_id" = ?', (canonical_id,)
+                )
+                con.execute('DELETE FROM "messages" WHERE "id" = ?', (canonical_id,))
+            if len(pruned) > 0:
+                self.vacuum_pages += vacuum_pages
+
+        self.execute(op)
+        return len(pruned)
+
+    def remove_blobs(self, blobs: List[str], vacuum_pages: int = 0) -> None:
+        # Forgets the ids of cached files that were removed. The blob column
+        # isn't indexed, so they go in a single scan.
+        placeholders = ", ".join("?" * len(blobs))
+
+        def op(con: sqlite3.Connection) -> None:
+            con.execute(f'DELETE FROM "blobs" WHERE "blob" IN ({placeholders})', blobs)
+            self.vacuum_pages += vacuum_pages
+
+        self.execute(op)
+
+    def clear(self) -> None:
+        self.cache.clear()
+
+        def op(con: sqlite3.Connection) -> None:
+            con.execute('DELETE FROM "mappings"')
+            con.execute('DELETE FROM "messages"')
+            con.execute('DELETE FROM "outbox"')
+            con.execute('DELETE FROM "blobs"')
+
+        self.submit(op)
@@ -1,33 +1,83 @@
-from threading import Thread
-from typing import Callable
-import requests
+import hashlib
 import os
+import uuid
 from pathlib import Path
 
+from typing import Optional, Tuple
 
-def run_in_thread(func: Callable, args: tuple):
-    thread = Thread(target=func, args=args)
-    thread.start()
+import aiohttp
 
 
-def download_to_cache(url: str, directory: str, filename: str, headers=None):
-    Path(directory).mkdir(parents=True, exist_ok=True)
+class FileTooLarge(Exception):
+    pass
 
-    with requests.get(url, stream=True, headers=headers) as r:
-        r.raise_for_status()
-        content_type = r.headers["content-type"]
 
-        filename = rename_with_proper_suffix(filename, content_type)
+async def download_to_cache(
+    session: aiohttp.ClientSession,
+    url: str,
+    directory: str,
+    headers=None,
+    timeout: Optional[aiohttp.ClientTimeout] = None,
+    max_size: Optional[int] = None,
+    in_memory: int = 0,
+) -> Tuple[str, Optional[bytes]]:
+    # Files are named after the hash of their content, so a file downloaded
+    # again, or from another messenger, is still only stored once. Returns
+    # the path of the file, or for files of at most in_memory bytes just
+    # its name and the content, without writing anything.
+    part_path = os.path.join(directory, f".{uuid.uuid4().hex}.part")
 
-        file_path = os.path.join(directory, filename)
-        with open(file_path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
+    digest = hashlib.sha256()
+    buffer = bytearray()
+    f = None
+    try:
+        async with session.get(url, headers=headers, timeout=timeout) as r:
+            r.raise_for_status()
+            content_type = r.headers["content-type"]
+            if max_size is not None and (r.content_length or 0) > max_size:
+                raise FileTooLarge(f"{url} has {r.content_length} bytes")
+            size = 0
+            async for chunk in r.content.iter_chunked(65536):
+                size += len(chunk)
+                # Content-Length may be missing or wrong
+                if max_size is not None and size > max_size:
+                    raise FileTooLarge(f"{url} has more than {max_size} bytes")
+                digest.update(chunk)
+                if f is None and size <= in_memory:
+                    buffer += chunk
+                    continue
+                if f is None:
+                    f = open_part(directory, part_path)
+                    f.write(buffer)
                 f.write(chunk)
-        return file_path
+            if f is None and in_memory == 0:
+                f = open_part(directory, part_path)
+    except BaseException:
+        if f is not None:
+            f.close()
+            os.remove(part_path)
+        raise
+
+    filename = rename_with_proper_suffix(digest.hexdigest(), content_type)
+    if f is None:
+        return filename, bytes(buffer)
+
+    f.close()
+    file_path = os.path.join(directory, filename)
+    if os.path.exists(file_path):
+        os.remove(part_path)
+    else:
+        os.replace(part_path, file_path)
+    return file_path, None
+
+
+def open_part(directory: str, part_path: str):
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    return open(part_path, "wb")
 
 
 def rename_with_proper_suffix(filename: str, content_type: str) -> str:
-    suffix = "." + content_type.split("/")[1]
+    suffix = "." + content_type.split(";")[0].split("/")[1].strip()
     if not filename.endswith(suffix):
         filename += suffix
     return filename